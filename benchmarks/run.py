@@ -0,0 +1,278 @@
+"""
+Бенчмарки обновления клиента и БД без внешних хостов: хосты заменяет локальный SSH/SFTP сервер
+(benchmarks/ssh_server.py), работающий с временным каталогом, БД обновлений и БД МО (s11) - SQLite.
+Данные генерируются с фиксированным seed, результаты сохраняются в JSON вместе с хэшем коммита,
+что позволяет сравнивать их между коммитами.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --output bench_new.json --compare bench.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+import paramiko
+from sqlalchemy import text
+from benchmarks.ssh_server import LocalSSHServer
+from update_tools import client_update, manifest
+from update_tools.bundle import ReleaseBundle
+from update_tools.client_update import UpdateFiles
+from update_tools.db_update import DbUpdater
+from update_tools.models import Base, Mo, Servers, Authdata, Updatequeries, engines
+from update_tools.scheduler import RolloutScheduler
+
+SEED = 20210323
+# количество файлов и размер файла для распределений размеров файлов
+DISTRIBUTIONS = {
+    'small': (2000, 4 * 1024),
+    'medium': (200, 256 * 1024),
+    'large': (4, 16 * 1024 * 1024),
+}
+TRANSFER_MODES = ('sftp', 'tar', 'bundle')
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    """
+    Многократный запуск функции с замером времени
+    :param func: замеряемая функция
+    :param repeat: количество запусков
+    :param setup: функция подготовки, выполняется перед каждым запуском и не замеряется
+    :return: минимальное и медианное время и время всех запусков в секундах
+    """
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+
+
+def make_tree(path: Path, count: int, size: int, seed: int = SEED):
+    """
+    Создание каталога с файлами случайного содержимого, по 100 файлов в подкаталоге
+    """
+    rnd = random.Random(seed)
+    for i in range(count):
+        file = path / f"dir{i // 100}" / f"file{i}.py"
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(rnd.randbytes(size))
+
+
+def make_release(statements: int, seed: int = SEED) -> str:
+    """
+    Синтетический скрипт релиза: INSERT со строками, содержащими разделители, комментарии и блок DELIMITER
+    """
+    rnd = random.Random(seed)
+    lines = ["-- synthetic release; generated", "CREATE TABLE IF NOT EXISTS bench (id INTEGER, note TEXT);"]
+    for i in range(statements):
+        lines.append(f"INSERT INTO bench (id, note) VALUES ({i}, 'note; {rnd.random()} it''s');  -- comment; {i}")
+    lines += ["DELIMITER $$", "/* trigger; */ CREATE TRIGGER bench_t AFTER INSERT ON bench BEGIN SELECT 1; END$$",
+              "DELIMITER ;"]
+    return '\n'.join(lines)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return ''
+
+
+class Benchmarks:
+    def __init__(self, workdir: Path, repeat: int):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.results = {}
+        self.server = LocalSSHServer().start()
+        self.key = paramiko.RSAKey.generate(2048)
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh.connect('127.0.0.1', port=self.server.port, username='root', pkey=self.key,
+                         look_for_keys=False, allow_agent=False)
+        # кэш локальных сумм и манифесты удалённого хоста во временном каталоге
+        client_update.CACHE_DIR = workdir / 'cache'
+        manifest.REMOTE_MANIFEST_DIR = f"{workdir / 'manifests'}/"
+
+    def close(self):
+        self.ssh.close()
+        self.server.stop()
+
+    def updater(self, local: Path, remote: Path, **kwargs) -> UpdateFiles:
+        """
+        Экземпляр UpdateFiles, подключенный к локальному SSH серверу, вывод сохраняется в буфер
+        """
+        files = UpdateFiles(software='mis', hash_cache=kwargs.pop('hash_cache', False), **kwargs)
+        files.local_path = f"{local}/"
+        files.remote_path = f"{remote}/"
+        files.ssh = self.ssh
+        files.output = []
+        return files
+
+    def record(self, name: str, result: dict, **info):
+        result.update(info)
+        self.results[name] = result
+        print(f"{name:40} min {result['min']:9.4f} с  median {result['median']:9.4f} с")
+
+    def bench_local_hash(self, local: Path, remote: Path):
+        files = self.updater(local, remote)
+        self.record('local_hash_cold', measure(files.get_hash_local_files, self.repeat))
+        files = self.updater(local, remote, hash_cache=True)
+        files.get_hash_local_files()
+        self.record('local_hash_cached', measure(files.get_hash_local_files, self.repeat))
+
+    def bench_remote_manifest(self, local: Path, remote: Path):
+        shutil.rmtree(remote, ignore_errors=True)
+        shutil.copytree(local, remote)
+        files = self.updater(local, remote)
+        files.get_hash_local_files()
+        self.record('remote_hash_full_scan', measure(files.get_hash_remote_files, self.repeat))
+        files = self.updater(local, remote, remote_manifest=True)
+        files.get_hash_local_files()
+        files.get_hash_remote_files()
+        files.save_remote_manifest()
+        self.record('remote_hash_stored_manifest', measure(files.get_hash_remote_files, self.repeat))
+
+    def bench_dict_differ(self, entries: int = 100000):
+        rnd = random.Random(SEED)
+        current = {f"dir{i // 100}/file{i}.py": f"{rnd.getrandbits(128):032x}" for i in range(entries)}
+        past = dict(current)
+        for key in rnd.sample(sorted(past), entries // 100):
+            past[key] = '0' * 32
+        for i in range(entries // 100):
+            current[f"new/file{i}.py"] = '1' * 32
+        self.record(f'dict_differ_{entries}', measure(lambda: UpdateFiles.dict_differ(current, past), self.repeat))
+
+    def bench_transfer(self):
+        for name, (count, size) in DISTRIBUTIONS.items():
+            local = self.workdir / f'transfer_{name}'
+            make_tree(local, count, size)
+            for mode in TRANSFER_MODES:
+                remote = self.workdir / f'remote_{name}_{mode}'
+                files = self.updater(local, remote, transfer=mode)
+                files.get_hash_local_files()
+                if mode == 'bundle':
+                    files.bundle = ReleaseBundle(files.local_path, files.hash_local, path=self.workdir / 'bundle')
+                    files.bundle.build()
+
+                def setup():
+                    shutil.rmtree(remote, ignore_errors=True)
+                    remote.mkdir(parents=True)
+                    files.hash_remote = {}
+                self.record(f'transfer_{name}_{mode}', measure(files.update_files, self.repeat, setup),
+                            files=count, bytes=count * size)
+
+    def bench_sql(self, statements: int = 5000):
+        script = make_release(statements)
+        self.record(f'sql_parse_{statements}', measure(lambda: DbUpdater.sql_parse(script), self.repeat))
+        queries = DbUpdater.sql_parse(script)
+        session = engines.session(f"sqlite:///{self.workdir / 's11.db'}")
+
+        def setup():
+            session.execute(text("DROP TABLE IF EXISTS bench"))
+            session.commit()
+        self.record(f'sql_execute_{statements}',
+                    measure(lambda: DbUpdater.execute_sql_queries(session, queries), self.repeat, setup))
+        session.close()
+
+    def bench_preload(self, servers: int = 200, releases: int = 10):
+        dsn = f"sqlite:///{self.workdir / 'misinfo.db'}"
+        Base.metadata.create_all(engines.get(dsn))
+        session = engines.session(dsn)
+        session.add_all([Mo(id=1, state='Район', name='МО', support=True)])
+        session.add_all([Servers(id=i, mo_id=1, poweron=True, ipv4=f"10.0.{i // 256}.{i % 256}", server_type='DB')
+                         for i in range(1, servers + 1)])
+        session.add_all([Authdata(user='user', password='password', server_id=i) for i in range(1, servers + 1)])
+        session.add_all([Updatequeries(id=i, releaseVersion=f"20210101{i:02}", sqlQuery='SELECT 1', run=True)
+                         for i in range(1, releases + 1)])
+        session.commit()
+        updater = DbUpdater(ipaddr=[f"10.0.{i // 256}.{i % 256}" for i in range(1, servers + 1)],
+                            rel=[f"20210101{i:02}" for i in range(1, releases + 1)])
+        updater.session = session
+        self.record(f'preload_{servers}x{releases}', measure(updater.preload, self.repeat))
+        session.close()
+
+    def bench_scheduler(self, hosts: int = 8, workers: int = 8, delay: float = 0.1):
+        """
+        Планировщик с одной группой хостов: одновременно должно обновляться workers хостов
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def update_host(host, throttle):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(delay)
+            with lock:
+                state['running'] -= 1
+            return True
+
+        def rollout():
+            RolloutScheduler(workers=workers).run(range(hosts), group=lambda host: None, func=update_host,
+                                                  succeeded=bool)
+        self.record(f'scheduler_one_group_{hosts}x{workers}', measure(rollout, self.repeat), peak=state['peak'])
+        if state['peak'] != min(hosts, workers):
+            raise RuntimeError(f"Планировщик: одновременно обновлялось {state['peak']} хостов из {workers}")
+
+    def run(self):
+        local = self.workdir / 'local'
+        make_tree(local, *DISTRIBUTIONS['medium'])
+        self.bench_local_hash(local, self.workdir / 'remote')
+        self.bench_remote_manifest(local, self.workdir / 'remote')
+        self.bench_dict_differ()
+        self.bench_transfer()
+        self.bench_sql()
+        self.bench_preload()
+        self.bench_scheduler()
+        return self.results
+
+
+def compare(results: dict, baseline_file: str):
+    """
+    Сравнение медианного времени с результатами другого запуска
+    """
+    with open(baseline_file, encoding='utf-8') as fn:
+        baseline = json.load(fn)
+    print(f"\nСравнение с {baseline.get('commit', '')[:10]}:")
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old:
+            print(f"{name:40} {old['median']:9.4f} -> {result['median']:9.4f} с  x{old['median'] / result['median']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки обновления клиента и БД')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='файл для сохранения результатов в JSON')
+    parser.add_argument('--compare', help='файл с результатами для сравнения')
+    args = parser.parse_args()
+    workdir = Path(tempfile.mkdtemp(prefix='mis_bench_'))
+    benchmarks = Benchmarks(workdir, args.repeat)
+    try:
+        results = benchmarks.run()
+    finally:
+        benchmarks.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'date': datetime.datetime.now().isoformat(), 'repeat': args.repeat, 'seed': SEED, 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fn:
+            json.dump(report, fn, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
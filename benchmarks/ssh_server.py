@@ -0,0 +1,187 @@
+"""
+Локальный SSH/SFTP сервер на paramiko для бенчмарков. Команды выполняются на локальном хосте,
+SFTP работает с локальной файловой системой, поэтому в качестве каталога удалённого хоста
+используется временный каталог.
+"""
+import os
+import socket
+import subprocess
+import threading
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+
+class _SFTPHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        return SFTP_OK
+
+
+class LocalSFTPServer(SFTPServerInterface):
+    """
+    SFTP сервер, работающий с локальной файловой системой
+    """
+    def list_folder(self, path):
+        try:
+            result = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            mode = getattr(attr, 'st_mode', None) or 0o666
+            fd = os.open(path, flags, mode)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        if flags & os.O_WRONLY:
+            fmode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fmode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fmode = 'rb'
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, fmode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(path, attr)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+        return SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    """
+    Авторизация по любому ключу, выполнение команд через /bin/sh на локальном хосте
+    """
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._run, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    @staticmethod
+    def _run(channel, command):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+
+        def pump_stdin():
+            while data := channel.recv(65536):
+                process.stdin.write(data)
+            process.stdin.close()
+
+        def pump_stderr():
+            while data := process.stderr.read(65536):
+                channel.sendall_stderr(data)
+
+        threads = [threading.Thread(target=pump_stdin, daemon=True), threading.Thread(target=pump_stderr, daemon=True)]
+        for thread in threads:
+            thread.start()
+        while data := process.stdout.read1(65536):
+            channel.sendall(data)
+        threads[1].join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+
+class LocalSSHServer:
+    """
+    SSH сервер на 127.0.0.1 со случайным портом, каждое подключение обслуживается в отдельном потоке
+    """
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+
+    def start(self):
+        self.sock.listen(16)
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, LocalSFTPServer)
+            transport.start_server(server=_ServerInterface())
+            self.transports.append(transport)
+
+    def stop(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
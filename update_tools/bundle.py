@@ -0,0 +1,83 @@
+import gzip
+import os
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from update_tools.manifest import CACHE_DIR
+
+BUNDLE_DIR = CACHE_DIR / 'bundles'
+
+
+class ReleaseBundle:
+    """
+    Сжатое хранилище содержимого файлов релиза с адресацией по сумме файла.
+    Файлы с одинаковым содержимым хранятся и передаются один раз, блоки сохраняются между запусками.
+    Блоки, адресуемые суммами разных алгоритмов, хранятся в отдельных каталогах.
+    """
+    def __init__(self, local_path: str, hashes: dict, path: Path = None, algorithm: str = 'md5'):
+        self.local_path = local_path
+        self.hashes = hashes
+        self.path = Path(path) if path else BUNDLE_DIR / algorithm
+
+    def blob(self, digest: str) -> Path:
+        """
+        Путь к сжатому блоку содержимого
+        :param digest: сумма файла
+        :return: путь к блоку
+        """
+        return self.path / f"{digest}.gz"
+
+    def _compress(self, file: str, digest: str):
+        """
+        Сжатие файла в блок. Блок записывается во временный файл и переименовывается после завершения
+        """
+        tmp_path = self.blob(digest).with_suffix('.tmp')
+        with open(Path(self.local_path, file), 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, self.blob(digest))
+
+    def build(self, workers: int = 4):
+        """
+        Сборка блоков для всех уникальных сумм локального каталога, уже собранные блоки не пересобираются
+        :param workers: количество потоков сжатия
+        :return: количество собранных блоков
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        sources = {}
+        for file, digest in self.hashes.items():
+            sources.setdefault(digest, file)
+        missing = [(file, digest) for digest, file in sources.items() if not self.blob(digest).exists()]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda item: self._compress(*item), missing))
+        return len(missing)
+
+    @staticmethod
+    def apply_script(tmp_dir: str, remote_path: str, targets: dict, remote_sources: dict) -> str:
+        """
+        Формирование скрипта для удалённого хоста, собирающего файлы из переданных блоков и из уже имеющихся
+        на хосте файлов с тем же содержимым. Сначала все файлы собираются во временные, затем переименовываются,
+        чтобы копируемые на хосте исходные файлы не были изменены до окончания сборки
+        :param tmp_dir: каталог на удалённом хосте с переданными блоками
+        :param remote_path: каталог клиента на удалённом хосте
+        :param targets: словарь {путь к файлу внутри директории: сумма}
+        :param remote_sources: словарь {сумма: путь к файлу на удалённом хосте с таким содержимым}
+        :return: скрипт sh
+        """
+        lines = ['set -e']
+        dirs = {Path(remote_path, file).parent.as_posix() for file in targets}
+        lines.append(f"mkdir -p {' '.join(shlex.quote(d) for d in sorted(dirs))}")
+        for file, digest in targets.items():
+            tmp_target = shlex.quote(Path(remote_path, file).as_posix() + '.bundle.tmp')
+            if digest in remote_sources:
+                source = shlex.quote(Path(remote_path, remote_sources[digest]).as_posix())
+                lines.append(f"cp {source} {tmp_target}")
+            else:
+                lines.append(f"gzip -dc {shlex.quote(f'{tmp_dir}/{digest}.gz')} > {tmp_target}")
+        for file in targets:
+            target = shlex.quote(Path(remote_path, file).as_posix())
+            tmp_target = shlex.quote(Path(remote_path, file).as_posix() + '.bundle.tmp')
+            lines.append(f"if [ -e {target} ]; then chmod --reference={target} {tmp_target}; fi")
+            lines.append(f"mv -f {tmp_target} {target}")
+        lines.append(f"rm -rf {shlex.quote(tmp_dir)}")
+        return '\n'.join(lines) + '\n'
@@ -1,18 +1,41 @@
+import contextlib
+import copy
+import datetime
 import hashlib
+import os
 import socket
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISREG
 from paramiko import BadHostKeyException, AuthenticationException, SSHException, ssh_exception
-from paramiko import RSAKey, SSHClient, AutoAddPolicy
+from paramiko import SSHClient, AutoAddPolicy
 from update_tools.models import Mo, Servers, DatabaseConnection
+from update_tools import delta
+from update_tools.bundle import ReleaseBundle
+from update_tools.ssh_pool import SSHSessionPool, get_ssh_key
+from update_tools.metrics import RolloutMetrics
+from update_tools.scheduler import RolloutScheduler, ThrottledWriter
+from update_tools.permissions import PERMISSION_POLICIES
+from update_tools.manifest import LocalManifestCache, CACHE_DIR, remote_manifest_path, parse_find_listing, \
+    load_remote_manifest, dump_remote_manifest, file_digest, remote_hash_command, parse_hash_line
 from config import settings
 from pathlib import PurePath, Path
 from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.orm.exc import NoResultFound
 
-SSH_KEY = RSAKey.from_private_key_file(settings.SSH_AUTH_KEY)
+# Каталог релиза, в который переносится каталог клиента при первом обновлении с подготовкой каталога (staged)
+INITIAL_RELEASE = '00000000000000'
 
 
 class UpdateFiles:
-    def __init__(self, software: str = None, data_mo = None, ignore=True, clear=False):
+    def __init__(self, software: str = None, data_mo = None, ignore=True, clear=False, workers: int = 1,
+                 hash_cache=True, hash_workers: int = 4, remote_manifest=False, rescan=False,
+                 transfer: str = 'sftp', delta_threshold: int = None, hash_algorithm: str = 'md5',
+                 mirror=False, pool: SSHSessionPool = None, metrics_jsonl: str = None, metrics_prom: str = None,
+                 group_workers: int = None, group_rate: int = None, canary: int = 0, relay=False,
+                 staged=False, stage_copy: str = 'hardlink', keep_releases: int = 3, full_permissions=False,
+                 total_rate: int = None):
         self.soft = software
         self.data_mo = data_mo
         self.hash_local = {}
@@ -23,6 +46,46 @@ class UpdateFiles:
         self.ssh = None
         self.config_command = None
         self.clear = clear
+        self.workers = workers
+        self.output = None
+        self.summary = {}
+        self.files_copied = 0
+        self.hash_cache = hash_cache
+        self.hash_workers = hash_workers
+        self.remote_manifest = remote_manifest
+        self.rescan = rescan
+        self.remote_listing = {}
+        self.transfer = transfer
+        self.bytes_sent = 0
+        self.delta_threshold = delta_threshold
+        self.bundle = None
+        self.hash_algorithm = hash_algorithm
+        self.mirror = mirror
+        self.files_deleted = 0
+        self.pool = pool
+        self.host = None
+        self.metrics = None
+        self.host_metrics = None
+        self.metrics_jsonl = metrics_jsonl
+        self.metrics_prom = metrics_prom
+        self.group_workers = group_workers
+        self.group_rate = group_rate
+        self.total_rate = total_rate
+        self.canary = canary
+        self.throttle = None
+        self.relay = relay
+        self.relays = {}
+        self.relay_host = None
+        self.restart_command = None
+        self.staged = staged
+        self.stage_copy = stage_copy
+        self.keep_releases = keep_releases
+        self.release_name = None
+        self.stage_path = None
+        self.live_path = None
+        self.permissions = None
+        self.full_permissions = full_permissions
+        self.changed_files = set()
 
     @staticmethod
     def md5(filename: Path):
@@ -31,11 +94,15 @@ class UpdateFiles:
         :param filename: путь к файлу
         :return: md5 сумма
         """
-        result = hashlib.md5()
-        with open(filename, "rb") as fn:
-            while d := fn.read(8192):
-                result.update(d)
-        return result.hexdigest()
+        return file_digest(filename, 'md5')
+
+    def file_hash(self, filename: Path):
+        """
+        Подсчёт суммы файла алгоритмом hash_algorithm
+        :param filename: путь к файлу
+        :return: сумма файла
+        """
+        return file_digest(filename, self.hash_algorithm)
 
     @staticmethod
     def dict_differ(current_dict: dict, past_dict: dict) -> set:
@@ -52,88 +119,475 @@ class UpdateFiles:
         file_list = change | add
         return file_list
 
+    @staticmethod
+    def dict_removed(current_dict: dict, past_dict: dict) -> set:
+        """
+        Возвращает ключи, которые есть в past_dict, но отсутствуют в current_dict
+        :param current_dict:
+        :param past_dict:
+        :return:
+        """
+        return set(past_dict.keys()) - set(current_dict.keys())
+
     def get_hash_local_files(self):
         """
             Функция для рекурсивного подсчёта md5 суммы файлов из указанной директории на локальном хосте.
-            :param path: Путь к директории, должен содержать закрывающий символ "/". Пример: get_path('/path/directory/')
-            :param ignore: Определяет, использовать список файлов исключений или нет
-            :param service: Имя сервиса, используется для списка игнорируемых файлов
+            Суммы сохраняются в кэше на диске, пересчитываются только новые и изменённые файлы (по размеру и
+            времени изменения). Подсчёт сумм выполняется параллельно в hash_workers потоках.
             :return: словарь, где ключ - путь к файлу, внутри указанной директории, значение - md5 сумма файла
             """
-        files = [file for file in list(Path(self.local_path).glob('**/*')) if file.is_file()]
-        for file in files:
-            if self.ignore:
-                if self.file_ignore(filename=file):
+        cache = None
+        if self.hash_cache:
+            cache_name = hashlib.md5(str(self.local_path).encode()).hexdigest()[:8]
+            cache = LocalManifestCache(CACHE_DIR / f"{self.soft}_{cache_name}.json", algorithm=self.hash_algorithm)
+            cache.load()
+        entries = {}
+        stale = []
+        for root, dirs, files in os.walk(self.local_path):
+            for name in files:
+                file = Path(root, name)
+                if self.ignore:
+                    if self.file_ignore(filename=file):
+                        continue
+                rel_path = file.as_posix()[len(self.local_path):]
+                # битые символические ссылки и специальные файлы пропускаются, как и в Path.is_file()
+                try:
+                    stat = file.stat()
+                except OSError:
                     continue
-            file_hash = self.md5(file)
-            self.hash_local[file.as_posix()[len(self.local_path):]] = file_hash
+                if not S_ISREG(stat.st_mode):
+                    continue
+                file_hash = cache.lookup(rel_path, stat) if cache else None
+                if file_hash:
+                    entries[rel_path] = [stat.st_size, stat.st_mtime_ns, file_hash]
+                else:
+                    stale.append((rel_path, file, stat))
+        with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+            hashes = executor.map(self.file_hash, [file for _, file, _ in stale])
+            for (rel_path, _, stat), file_hash in zip(stale, hashes):
+                entries[rel_path] = [stat.st_size, stat.st_mtime_ns, file_hash]
+        if cache:
+            cache.save(entries)
+        self.hash_local = {file: entry[2] for file, entry in entries.items()}
+        return self.hash_local
+
+    def check_remote_hash_command(self) -> bool:
+        """
+        Проверка наличия на удалённом хосте команды подсчёта сумм алгоритма hash_algorithm
+        (b2sum есть в coreutils начиная с 8.26, xxh64sum устанавливается отдельно)
+        :return: True - команда доступна
+        """
+        command = remote_hash_command(self.hash_algorithm).split()[0]
+        stdin, stdout, stderr = self.ssh.exec_command(f"command -v {command}")
+        if stdout.channel.recv_exit_status() != 0:
+            self.count_error('RemoteCommandError')
+            self.log(f"На сервере нет команды {command} для подсчёта сумм алгоритмом {self.hash_algorithm}")
+            return False
+        return True
 
     def get_hash_remote_files(self):
         """
-        Функция для рекурсивного подсчёта md5 суммы файлов из указанной директории на удалённом хосте
-        :param path: Путь к директории, должен содержать закрывающий символ "/". Пример: get_path('/path/directory/')
-        :param ssh: объект ssh.connect
-        :param ignore: Определяет, использовать список файлов исключений или нет
-        :param service: Имя сервиса, используется для списка игнорируемых файлов
+        Функция для рекурсивного подсчёта md5 суммы файлов из указанной директории на удалённом хосте.
+        При включенном remote_manifest суммы берутся из сохранённого на хосте манифеста для файлов, у которых
+        не изменились размер и время изменения, остальные файлы пересчитываются. Полный пересчёт выполняется
+        при отсутствии манифеста или при rescan=True
         :return: словарь, где ключ - путь к файлу, внутри указанной директории, значение - md5 сумма файла
         """
         self.hash_remote = {}
-        stdin, stdout, stderr = self.ssh.exec_command(f'find {self.remote_path} -type f | xargs -d "\\n" md5sum -b')
-        files = stdout.readlines()
-        for f in files:
-            file_hash, file = f.split('*')
-            file = file.strip(' \r\n')
+        if self.remote_manifest:
+            self.remote_listing = self.get_remote_listing()
+            stored = {} if self.rescan else self.read_remote_manifest()
+            if stored:
+                stale = []
+                for file, (size, mtime) in self.remote_listing.items():
+                    if self.ignore:
+                        if self.file_ignore(file):
+                            continue
+                    entry = stored.get(file)
+                    if entry and entry[0] == size and entry[1] == mtime:
+                        self.hash_remote[file] = entry[2]
+                    else:
+                        stale.append(file)
+                if stale:
+                    self.log(f"Изменённых файлов на сервере: {len(stale)}, выполняется подсчёт сумм")
+                    self.hash_remote.update(self.get_hash_remote_list(stale))
+                return self.hash_remote
+        stdin, stdout, stderr = self.ssh.exec_command(f'find {self.remote_path} -type f | '
+                                                      f'xargs -d "\\n" {remote_hash_command(self.hash_algorithm)}')
+        for f in stdout:
+            file_hash, file = parse_hash_line(f)
             file = file[len(self.remote_path):]
             if self.ignore:
                 if self.file_ignore(file):
                     continue
-            file_hash = file_hash.strip(' \r\n')
             self.hash_remote[file] = file_hash
+        return self.hash_remote
+
+    def get_hash_remote_list(self, files: list) -> dict:
+        """
+        Подсчёт сумм указанных файлов на удалённом хосте
+        :param files: список путей к файлам внутри директории
+        :return: словарь {путь к файлу: сумма}
+        """
+        hashes = {}
+        stdin, stdout, stderr = self.ssh.exec_command(f'cd {self.remote_path} && '
+                                                      f'xargs -0 -r {remote_hash_command(self.hash_algorithm)}')
+        stdin.write('\0'.join(files))
+        stdin.channel.shutdown_write()
+        for f in stdout:
+            file_hash, file = parse_hash_line(f)
+            hashes[file] = file_hash
+        return hashes
+
+    def get_remote_listing(self) -> dict:
+        """
+        Получение размера и времени изменения файлов на удалённом хосте
+        :return: словарь {путь к файлу: (размер, время изменения)}
+        """
+        stdin, stdout, stderr = self.ssh.exec_command(f"find {self.remote_path} -type f -printf '%s %T@ %P\\n'")
+        return parse_find_listing(stdout)
+
+    def read_remote_manifest(self) -> dict:
+        """
+        Чтение сохранённого на удалённом хосте манифеста
+        :return: словарь {путь: [размер, время изменения, сумма]}
+        """
+        stdin, stdout, stderr = self.ssh.exec_command(f"cat {remote_manifest_path(self.soft, self.remote_path)}")
+        data = stdout.read()
+        if stdout.channel.recv_exit_status() != 0:
+            self.log("Манифест файлов на сервере отсутствует, выполняется полный подсчёт сумм")
+            return {}
+        return load_remote_manifest(data, self.hash_algorithm)
+
+    def save_remote_manifest(self):
+        """
+        Сохранение манифеста на удалённом хосте после успешного обновления. Суммы файлов, совпадающих
+        с локальными, берутся из локального манифеста, размер и время изменения - с удалённого хоста
+        """
+        files = {}
+        for file, (size, mtime) in self.get_remote_listing().items():
+            file_hash = self.hash_local.get(file) or self.hash_remote.get(file)
+            if file_hash:
+                files[file] = [size, mtime, file_hash]
+        manifest_path = remote_manifest_path(self.soft, self.remote_path)
+        stdin, stdout, stderr = self.ssh.exec_command(f"mkdir -p {Path(manifest_path).parent.as_posix()} && "
+                                                      f"cat > {manifest_path}.tmp && mv {manifest_path}.tmp "
+                                                      f"{manifest_path}")
+        stdin.write(dump_remote_manifest(files, self.hash_algorithm))
+        stdin.channel.shutdown_write()
+        if stdout.channel.recv_exit_status() != 0:
+            self.count_error('RemoteCommandError')
+            self.log(f"Не удалось сохранить манифест файлов: {stderr.read()}")
 
     def update_files(self):
         """
-        Выполняет обновление файлов в каталоге на внешнем хосте в соответствии с файлами на локальном хосте
+        Выполняет обновление файлов в каталоге на внешнем хосте в соответствии с файлами на локальном хосте.
+        Способ передачи определяется параметром transfer: sftp - по файлу через одну сессию SFTP,
+        tar - одним потоком tar-архива, распаковываемого на удалённом хосте, bundle - сжатыми блоками
+        из общего для всех хостов хранилища релиза.
+        Изменённые файлы размером не менее delta_threshold передаются разницей по блокам.
+        В режиме relay файлы сначала забираются с уже обновлённого хоста района (relay_host)
+        :return: True - все файлы скопированы без ошибок
         """
         file_list = self.dict_differ(self.hash_local, self.hash_remote)
+        self.changed_files = set(file_list)
+        self.files_copied = 0
+        self.bytes_sent = 0
         if not file_list:
-            print("Версия клиента актуальна")
+            self.log("Версия клиента актуальна")
             return True
-        print(f"Файлов для копирования: {len(file_list)}")
+        self.log(f"Файлов для копирования: {len(file_list)}")
+        start = time.monotonic()
+        if self.relay_host:
+            file_list = self.transfer_relay(file_list)
+        if file_list and self.delta_threshold is not None:
+            file_list = self.transfer_delta(file_list)
+        if not file_list:
+            success = True
+        elif self.transfer == 'tar':
+            success = self.transfer_tar(file_list)
+        elif self.transfer == 'bundle':
+            success = self.transfer_bundle(file_list)
+        else:
+            success = self.transfer_sftp(file_list)
+        elapsed = max(time.monotonic() - start, 0.001)
+        self.log(f"Передано файлов: {self.files_copied}, байт: {self.bytes_sent} за {elapsed:.1f} с "
+                 f"({self.files_copied / elapsed:.1f} файлов/с, {self.bytes_sent / elapsed:.0f} байт/с)")
+        return success
+
+    def make_remote_dirs(self, file_list) -> bool:
+        """
+        Создание на удалённом хосте каталогов для копируемых файлов одной командой
+        :param file_list: список путей к файлам внутри директории
+        :return: True - каталоги созданы
+        """
+        dirs = {Path(self.remote_path, file).parent.as_posix() for file in file_list}
+        stdin, stdout, stderr = self.ssh.exec_command('xargs -0 -r mkdir -p')
+        stdin.write('\0'.join(dirs))
+        stdin.channel.shutdown_write()
+        if stdout.channel.recv_exit_status() != 0:
+            self.count_error('RemoteCommandError')
+            self.log(f"Не удалось создать каталоги: {stderr.read()}")
+            return False
+        return True
+
+    def transfer_sftp(self, file_list) -> bool:
+        """
+        Копирование файлов через одну сессию SFTP
+        :param file_list: список путей к файлам внутри директории
+        :return: True - все файлы скопированы без ошибок
+        """
+        # На случай, если конечные каталоги для копирования файлов отсутствуют, создаём их
+        if not self.make_remote_dirs(file_list):
+            return False
+        success = True
+        sftp = self.pool.sftp(self.host) if self.pool else self.ssh.open_sftp()
+        try:
+            for file in file_list:
+                source_file = Path(self.local_path, file)
+                destination_file = Path(self.remote_path, file)
+                try:
+                    if self.stage_path:
+                        # файлы каталога релиза могут быть жёсткими ссылками на файлы рабочего каталога
+                        attr = sftp.put(source_file, f"{destination_file.as_posix()}.tmp", callback=self.sftp_throttle())
+                        sftp.posix_rename(f"{destination_file.as_posix()}.tmp", destination_file.as_posix())
+                    else:
+                        attr = sftp.put(source_file, destination_file.as_posix(), callback=self.sftp_throttle())
+                except socket.error as err:
+                    self.count_error(err)
+                    self.log("Socket Error: {}\n{}\n{}".format(err, source_file, destination_file))
+                    success = False
+                except TypeError as err:
+                    self.count_error(err)
+                    self.log("Type Error: {}".format(err))
+                    success = False
+                except ssh_exception.SSHException as err:
+                    self.count_error(err)
+                    self.log("Paramiko Error: {}".format(err))
+                    success = False
+                except EOFError as err:
+                    self.count_error(err)
+                    self.log("EOFError Error: {}".format(err))
+                    success = False
+                else:
+                    self.files_copied += 1
+                    self.bytes_sent += attr.st_size
+                    self.log("Скопирован файл: {}".format(file))
+        finally:
+            if not self.pool:
+                sftp.close()
+        return success
+
+    def transfer_relay(self, file_list) -> set:
+        """
+        Получение файлов хостом с уже обновлённого хоста района (relay_host) по SSH одним потоком tar-архива.
+        На хосте-источнике файлы берутся из рабочего каталога клиента (live_path), в режиме staged
+        на текущем хосте они записываются в каталог релиза.
+        Суммы полученных файлов сверяются с локальными, не полученные или не совпавшие файлы
+        передаются с локального хоста
+        :param file_list: список путей к файлам внутри директории
+        :return: файлы, которые нужно передать с локального хоста
+        """
+        remaining = set(file_list)
+        relay_path = self.live_path or self.remote_path
+        try:
+            stdin, stdout, stderr = self.ssh.exec_command(
+                f"mkdir -p {self.remote_path} && ssh -o BatchMode=yes -o StrictHostKeyChecking=no "
+                f"-o ConnectTimeout=10 root@{self.relay_host} 'cd {relay_path} && tar -cf - --null -T -' | "
+                f"tar -xf - --no-same-owner -C {self.remote_path}")
+            stdin.write('\0'.join(file_list))
+            stdin.channel.shutdown_write()
+            if stdout.channel.recv_exit_status() != 0:
+                self.count_error('RemoteCommandError')
+                self.log(f"Не удалось получить файлы с хоста {self.relay_host}: {stderr.read()}")
+            hashes = self.get_hash_remote_list(list(file_list))
+        except (socket.error, ssh_exception.SSHException, EOFError) as err:
+            self.count_error(err)
+            self.log(f"Ошибка получения файлов с хоста {self.relay_host}: {err}")
+            # содержимое файлов могло быть частично изменено, они не используются как источники на хосте
+            for file in file_list:
+                self.hash_remote.pop(file, None)
+            return remaining
+        # суммы файлов на хосте после получения, используются следующими способами передачи
+        for file in file_list:
+            if file in hashes:
+                self.hash_remote[file] = hashes[file]
+            else:
+                self.hash_remote.pop(file, None)
+        received = {file for file in remaining if hashes.get(file) == self.hash_local[file]}
+        remaining -= received
+        self.files_copied += len(received)
+        self.log(f"Получено файлов с хоста {self.relay_host}: {len(received)}"
+                 + (f", передаются с локального хоста: {len(remaining)}" if remaining else ""))
+        return remaining
+
+    def transfer_delta(self, file_list) -> set:
+        """
+        Передача разницы по блокам для изменённых файлов размером не менее delta_threshold.
+        Файлы, для которых передача разницы не выгодна или завершилась ошибкой, передаются целиком
+        :param file_list: список путей к файлам внутри директории
+        :return: файлы, которые нужно передать целиком
+        """
+        remaining = set(file_list)
         for file in file_list:
             source_file = Path(self.local_path, file)
-            destination_file = Path(self.remote_path, file)
+            if file not in self.hash_remote or source_file.stat().st_size < self.delta_threshold:
+                continue
+            destination_file = Path(self.remote_path, file).as_posix()
             try:
-                # На случай, если конечный каталог для копирования файла отсутствует, создаём его
-                dir = destination_file.parent.as_posix()
-                self.ssh.exec_command(f"mkdir -p {dir}")
-                # копируем файл
-                sftp = self.ssh.open_sftp()
-                sftp.put(source_file, destination_file.as_posix())
-            except socket.error as err:
-                print("Socket Error: {}\n{}\n{}".format(err, source_file, destination_file))
-            except TypeError as err:
-                print("Type Error: {}".format(err))
-            except ssh_exception.SSHException as err:
-                print("Paramiko Error: {}".format(err))
-            except EOFError as err:
-                print("EOFError Error: {}".format(err))
-            else:
-                print("Скопирован файл: {}".format(file))
+                stdin, stdout, stderr = self.ssh.exec_command(delta.signature_command(destination_file))
+                signature = delta.parse_signature(stdout)
+                if stdout.channel.recv_exit_status() != 0:
+                    self.count_error('RemoteCommandError')
+                    self.log(f"Не удалось получить суммы блоков файла {file}: {stderr.read()}")
+                    continue
+                ops = delta.compute_delta(source_file.read_bytes(), signature)
+                if ops is None:
+                    continue
+                stdin, stdout, stderr = self.ssh.exec_command(delta.patch_command(destination_file))
+                writer = self.throttled(stdin)
+                for op in ops:
+                    writer.write(op)
+                stdin.channel.shutdown_write()
+                if stdout.channel.recv_exit_status() != 0:
+                    self.count_error('RemoteCommandError')
+                    self.log(f"Не удалось собрать файл {file}: {stderr.read()}")
+                    continue
+            except (socket.error, ssh_exception.SSHException, EOFError) as err:
+                self.count_error(err)
+                self.log(f"Ошибка передачи разницы файла {file}: {err}")
+                self.hash_remote.pop(file, None)
+                continue
+            self.hash_remote[file] = self.hash_local[file]
+            remaining.discard(file)
+            self.files_copied += 1
+            self.bytes_sent += sum(len(op) for op in ops)
+            self.log(f"Передана разница файла: {file}")
+        return remaining
+
+    def transfer_tar(self, file_list) -> bool:
+        """
+        Копирование файлов одним потоком tar-архива через один канал, архив распаковывается на удалённом хосте
+        :param file_list: список путей к файлам внутри директории
+        :return: True - все файлы скопированы без ошибок
+        """
+        try:
+            stdin, stdout, stderr = self.ssh.exec_command(f"mkdir -p {self.remote_path} && "
+                                                          f"tar -xf - --no-same-owner -C {self.remote_path}")
+            with tarfile.open(fileobj=self.throttled(stdin), mode='w|') as tar:
+                for file in file_list:
+                    source_file = Path(self.local_path, file)
+                    tar.add(source_file, arcname=file, recursive=False)
+                    self.bytes_sent += source_file.stat().st_size
+            stdin.channel.shutdown_write()
+            if stdout.channel.recv_exit_status() != 0:
+                self.count_error('RemoteCommandError')
+                self.log(f"Ошибка распаковки архива: {stderr.read()}")
+                return False
+        except (socket.error, ssh_exception.SSHException, EOFError) as err:
+            self.count_error(err)
+            self.log(f"Ошибка передачи архива: {err}")
+            return False
+        self.files_copied += len(file_list)
+        return True
+
+    def transfer_bundle(self, file_list) -> bool:
+        """
+        Копирование файлов сжатыми блоками из хранилища релиза. Передаются только блоки, содержимого которых
+        нет на удалённом хосте, файлы с уже имеющимся на хосте содержимым копируются на месте.
+        Источники на хосте берутся из hash_remote, обновляемого предыдущими способами передачи (relay, delta).
+        Суммы собранных файлов сверяются с локальными
+        :param file_list: список путей к файлам внутри директории
+        :return: True - все файлы скопированы без ошибок
+        """
+        targets = {file: self.hash_local[file] for file in file_list}
+        remote_sources = {}
+        for file, file_hash in self.hash_remote.items():
+            remote_sources.setdefault(file_hash, file)
+        digests = set(targets.values()) - set(remote_sources)
+        try:
+            stdin, stdout, stderr = self.ssh.exec_command('mktemp -d')
+            tmp_dir = stdout.read().decode().strip()
+            if stdout.channel.recv_exit_status() != 0:
+                self.count_error('RemoteCommandError')
+                self.log(f"Не удалось создать временный каталог: {stderr.read()}")
+                return False
+            stdin, stdout, stderr = self.ssh.exec_command(f"tar -xf - --no-same-owner -C {tmp_dir}")
+            with tarfile.open(fileobj=self.throttled(stdin), mode='w|') as tar:
+                for digest in digests:
+                    blob = self.bundle.blob(digest)
+                    tar.add(blob, arcname=blob.name, recursive=False)
+                    self.bytes_sent += blob.stat().st_size
+            stdin.channel.shutdown_write()
+            if stdout.channel.recv_exit_status() != 0:
+                self.count_error('RemoteCommandError')
+                self.log(f"Ошибка распаковки архива: {stderr.read()}")
+                return False
+            stdin, stdout, stderr = self.ssh.exec_command('sh -s')
+            stdin.write(ReleaseBundle.apply_script(tmp_dir, self.remote_path, targets, remote_sources))
+            stdin.channel.shutdown_write()
+            if stdout.channel.recv_exit_status() != 0:
+                self.count_error('RemoteCommandError')
+                self.log(f"Ошибка сборки файлов из блоков: {stderr.read()}")
+                return False
+            hashes = self.get_hash_remote_list(list(targets))
+        except (socket.error, ssh_exception.SSHException, EOFError) as err:
+            self.count_error(err)
+            self.log(f"Ошибка передачи блоков: {err}")
+            return False
+        self.hash_remote.update(hashes)
+        mismatched = sorted(file for file, file_hash in targets.items() if hashes.get(file) != file_hash)
+        self.log(f"Передано блоков: {len(digests)}, скопировано на хосте: {len(file_list) - len(digests)}")
+        self.files_copied += len(file_list) - len(mismatched)
+        if mismatched:
+            self.count_error('ChecksumMismatch')
+            self.log(f"Суммы собранных файлов не совпадают с локальными: {', '.join(mismatched)}")
+            return False
+        return True
+
+    def remove_extraneous_files(self) -> bool:
+        """
+        Удаление одной командой файлов, которые есть на удалённом хосте, но отсутствуют в локальном каталоге.
+        Файлы из списка исключений file_ignore не удаляются
+        :return: True - файлы удалены без ошибок
+        """
+        self.files_deleted = 0
+        files = [file for file in self.dict_removed(self.hash_local, self.hash_remote) if not self.file_ignore(file)]
+        if not files:
+            return True
+        stdin, stdout, stderr = self.ssh.exec_command(f'cd {self.remote_path} && xargs -0 -r rm -f --')
+        stdin.write('\0'.join(files))
+        stdin.channel.shutdown_write()
+        if stdout.channel.recv_exit_status() != 0:
+            self.count_error('RemoteCommandError')
+            self.log(f"Не удалось удалить лишние файлы: {stderr.read()}")
+            return False
+        for file in files:
+            self.hash_remote.pop(file)
+        self.files_deleted = len(files)
+        self.log(f"Удалено лишних файлов: {self.files_deleted}")
+        return True
 
     def ssh_connect(self, ipv4):
         """
-        Создание экземпляра класса SSHClient (Paramiko)
+        Создание экземпляра класса SSHClient (Paramiko). При заданном пуле подключений используется
+        подключение из пула
         :param ipv4: IP адрес для подключения
         """
+        self.host = ipv4
         try:
+            if self.pool:
+                self.ssh = self.pool.get(ipv4)
+                return True
             self.ssh = SSHClient()
             # ssh.load_host_keys(KNOWN_HOST)
             self.ssh.set_missing_host_key_policy(AutoAddPolicy())
-            self.ssh.connect(hostname=ipv4, port=22, username='root', pkey=SSH_KEY)
+            self.ssh.connect(hostname=ipv4, port=22, username='root', pkey=get_ssh_key())
             return True
         except (AuthenticationException, TimeoutError, BadHostKeyException, ConnectionResetError,
-                ssh_exception.NoValidConnectionsError) as err:
-            print("Error: {}\n".format(err))
+                ssh_exception.NoValidConnectionsError, SSHException, OSError) as err:
+            self.count_error(err)
+            self.log("Error: {}: {}\n".format(ipv4, err))
             self.ssh = None
 
     def set_paths(self, local_path: Path = None, remote_path: Path = None):
@@ -157,27 +611,18 @@ class UpdateFiles:
 
     def set_config_command(self, command=None):
         """
-        Устанавливает команды, выполняемые после обновления файлов
+        Устанавливает команды, выполняемые после обновления файлов: права на файлы (permissions),
+        настройка файлов (config_command) и перезапуск сервисов (restart_command)
         :param command:
         :return:
         """
-        if self.soft == 'mis':
-            self.config_command = f'chown tsadmin:samsonuser -R {self.remote_path} && chmod 775 -R {self.remote_path} && ' \
-                             f'find {self.remote_path} -type f | xargs -d "\\n" chmod 664 && ' \
-                             f'chmod +x {self.remote_path}s11main.py && ' \
-                             f'chmod +x {self.remote_path}appendix/regional/r23/importReestr/importReestr.py'
-        elif self.soft == 'iemk':
-            self.config_command = f'chown root:root -R {self.remote_path} && chmod 775 -R {self.remote_path} && ' \
-                                  f'find {self.remote_path} -type f | xargs -d "\\n" chmod 664 && ' \
-                                  f'chmod +x {self.remote_path}run_iemk.sh && ' \
-                                  f'chmod +x {self.remote_path}run_putev.sh && ' \
-                                  f'chmod +x {self.remote_path}IEMK/IEMKrequest.php && ' \
-                                  f'chmod +x {self.remote_path}putevFactExecs.py &&' \
-                                  f'chmod +x {self.remote_path}run_smphosp.sh'
-        elif self.soft == 'soap':
-            self.config_command = f'systemctl restart httpd; systemctl restart apache2'
+        self.permissions = PERMISSION_POLICIES.get(self.soft)
+        if self.soft in PERMISSION_POLICIES:
+            self.config_command = None
         else:
             self.config_command = command
+        if self.soft == 'soap':
+            self.restart_command = f'systemctl restart httpd; systemctl restart apache2'
 
     def __setup(self):
         """
@@ -194,9 +639,60 @@ class UpdateFiles:
             data = stdout.read() + stderr.read()
             return data
         except (SSHException, AttributeError) as err:
-            print(err)
+            self.log(err)
             return None
 
+    def log(self, *args):
+        """
+        Вывод сообщения. При параллельном обновлении сообщения накапливаются в буфере хоста
+        и выводятся одним блоком после завершения обновления на нём
+        """
+        if self.output is None:
+            print(*args)
+        else:
+            self.output.append(' '.join(str(arg) for arg in args))
+
+    def count_error(self, err):
+        """
+        Учёт ошибки в метриках хоста
+        :param err: исключение или имя класса ошибки
+        """
+        if self.host_metrics:
+            self.host_metrics.add_error(err)
+
+    def phase(self, name: str):
+        """
+        Замер длительности этапа обновления хоста (или запуска, если хост не обновляется)
+        :param name: имя этапа
+        :return: контекстный менеджер
+        """
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.phase(name, self.host_metrics)
+
+    def throttled(self, stream):
+        """
+        Ограничение скорости записи в канал по корзине группы хоста
+        :param stream: поток записи канала
+        :return: поток с ограничением скорости или исходный поток, если скорость не ограничена
+        """
+        return ThrottledWriter(stream, self.throttle) if self.throttle else stream
+
+    def sftp_throttle(self):
+        """
+        Функция обратного вызова SFTP put, ограничивающая скорость передачи файла по корзине группы хоста
+        :return: функция или None, если скорость не ограничена
+        """
+        if not self.throttle:
+            return None
+        sent = 0
+
+        def callback(transferred, total):
+            nonlocal sent
+            self.throttle.consume(transferred - sent)
+            sent = transferred
+        return callback
+
     def file_ignore(self, filename):
         """
         Используется для исключения файлов/каталогов при подсчёте md5 суммы
@@ -219,6 +715,119 @@ class UpdateFiles:
     def set_ignore(self, flag: bool):
         self.ignore = flag
 
+    def apply_permissions(self, full: bool = False):
+        """
+        Установка прав на файлы по политике permissions: на весь каталог при первой установке или
+        full_permissions, иначе только на изменённые в этом запуске файлы и их каталоги
+        :param full: установить права на весь каталог
+        """
+        if not self.permissions:
+            return
+        if full or self.full_permissions:
+            self.log("Установка прав на все файлы клиента")
+            self.log(self.ssh_run_command(self.permissions.full_command(self.remote_path)))
+            return
+        if not self.changed_files:
+            return
+        for command, paths in self.permissions.incremental(self.remote_path, self.changed_files):
+            stdin, stdout, stderr = self.ssh.exec_command(command)
+            stdin.write('\0'.join(paths))
+            stdin.channel.shutdown_write()
+            if stdout.channel.recv_exit_status() != 0:
+                self.count_error('RemoteCommandError')
+                self.log(f"Не удалось установить права на файлы: {stderr.read()}")
+
+    def release_paths(self) -> tuple:
+        """
+        Пути для обновления с подготовкой каталога: каталог клиента (символическая ссылка на текущий релиз)
+        и каталог релизов рядом с ним
+        :return: (каталог клиента, каталог релизов)
+        """
+        base = self.remote_path.rstrip('/')
+        return base, f"{base}.releases"
+
+    def prepare_stage(self) -> bool:
+        """
+        Создание каталога нового релиза из текущего каталога клиента: жёсткими ссылками (stage_copy='hardlink')
+        или копированием с reflink на файловых системах, которые его поддерживают (stage_copy='reflink')
+        :return: True - каталог создан, путь в stage_path
+        """
+        base, releases = self.release_paths()
+        stage = f"{releases}/{self.release_name}"
+        copy_command = 'cp -al' if self.stage_copy == 'hardlink' else 'cp -a --reflink=auto'
+        stdin, stdout, stderr = self.ssh.exec_command(
+            f"mkdir -p {releases} && rm -rf {stage} && "
+            f"if [ -d {base} ]; then {copy_command} {base}/. {stage}; else mkdir -p {stage}; fi")
+        if stdout.channel.recv_exit_status() != 0:
+            self.count_error('RemoteCommandError')
+            self.log(f"Не удалось подготовить каталог релиза: {stderr.read()}")
+            return False
+        self.stage_path = stage
+        return True
+
+    def discard_stage(self):
+        """
+        Удаление каталога релиза, не ставшего текущим
+        """
+        if self.stage_path:
+            self.ssh_run_command(f"rm -rf {self.stage_path}")
+            self.stage_path = None
+
+    def swap_release(self, target: str) -> bool:
+        """
+        Переключение каталога клиента на каталог релиза заменой символической ссылки (mv -T).
+        Если каталог клиента - обычный каталог, он переносится в каталог релизов как INITIAL_RELEASE.
+        Хранятся keep_releases последних релизов, текущий релиз не удаляется
+        :param target: каталог релиза
+        :return: True - каталог клиента переключён
+        """
+        base, releases = self.release_paths()
+        stdin, stdout, stderr = self.ssh.exec_command(
+            f"if [ -d {base} ] && [ ! -L {base} ]; then mv -T {base} {releases}/{INITIAL_RELEASE} || exit 1; fi; "
+            f"ln -sfn {target} {base}.link && mv -T {base}.link {base} || "
+            f"{{ [ -e {base} ] || mv -T {releases}/{INITIAL_RELEASE} {base}; exit 1; }}; "
+            f"current=$(readlink -f {base}); cd {releases} && "
+            f"for release in $(ls -1 | sort | head -n -{self.keep_releases}); do "
+            f"[ \"$(readlink -f $release)\" = \"$current\" ] || rm -rf -- \"$release\"; done; exit 0")
+        if stdout.channel.recv_exit_status() != 0:
+            self.count_error('RemoteCommandError')
+            self.log(f"Не удалось переключить каталог клиента на {target}: {stderr.read()}")
+            return False
+        self.log(f"Каталог клиента переключён на {target}")
+        return True
+
+    def rollback_host(self, mo) -> str:
+        """
+        Возврат каталога клиента на хосте к предыдущему релизу из каталога релизов
+        :param mo: строка из get_mo_data: Mo.id, Mo.state, Mo.name, Servers.ipv4
+        :return: результат: succeeded или failed
+        """
+        if not self.ssh_connect(ipv4=mo.ipv4):
+            return 'failed'
+        self.log(f"\nВозврат к предыдущему релизу на сервере {mo.ipv4} в {mo.state} {mo.name}:")
+        base, releases = self.release_paths()
+        try:
+            stdin, stdout, stderr = self.ssh.exec_command(
+                f"current=$(readlink -f {base}); previous=''; "
+                f"for release in $(ls -1d {releases}/* | sort); do release=$(readlink -f $release); "
+                f"[ \"$release\" = \"$current\" ] && break; previous=$release; done; "
+                f"[ -n \"$previous\" ] && [ \"$release\" = \"$current\" ] && echo $previous")
+            previous = stdout.read().decode().strip()
+            if not previous:
+                self.log(f"Предыдущий релиз не найден: {stderr.read()}")
+                return 'failed'
+            if not self.swap_release(previous):
+                return 'failed'
+            if self.restart_command:
+                self.log(self.ssh_run_command(self.restart_command))
+        except (SSHException, socket.error, EOFError) as err:
+            self.log(f"Ошибка при возврате к предыдущему релизу на сервере {mo.ipv4}: {err}")
+            return 'failed'
+        finally:
+            if not self.pool:
+                self.ssh.close()
+        return 'succeeded'
+
     def clear_remote_path(self, soft):
         if soft == 'soap':
             clear_command = f'cp {self.remote_path}config/config.php {self.remote_path}../ && ' \
@@ -259,12 +868,166 @@ class UpdateFiles:
         finally:
             session.close()
 
-    def update(self):
+    def update_host(self, mo) -> str:
         """
-        Выполнение обновления файлов по списку указанных хостов
+        Выполнение обновления файлов на одном хосте с учётом метрик хоста
+        :param mo: строка из get_mo_data: Mo.id, Mo.state, Mo.name, Servers.ipv4
+        :return: результат обновления: succeeded, failed или skipped (клиент актуален)
+        """
+        self.host_metrics = self.metrics.host(mo.ipv4, mo.state, mo.name) if self.metrics else None
+        status = self._update_host(mo)
+        if self.host_metrics:
+            self.host_metrics.status = status
+            self.host_metrics.files = self.files_copied
+            self.host_metrics.deleted = self.files_deleted
+            self.host_metrics.bytes = self.bytes_sent
+        return status
+
+    def _update_host(self, mo) -> str:
+        """
+        Этапы обновления файлов на одном хосте. В режиме mirror вместо полной очистки каталога (clear)
+        удаляются только файлы, отсутствующие в локальном каталоге
+        :param mo: строка из get_mo_data: Mo.id, Mo.state, Mo.name, Servers.ipv4
+        :return: результат обновления: succeeded, failed или skipped (клиент актуален)
+        """
+        self.files_copied = self.files_deleted = self.bytes_sent = 0
+        with self.phase('connect'):
+            connected = self.ssh_connect(ipv4=mo.ipv4)
+        if not connected:
+            return 'failed'
+        self.log(f"\nВыполняется обновление на сервере {mo.ipv4} в {mo.state} {mo.name}:")
+        live_path = self.live_path = self.remote_path
+        try:
+            if self.clear and not self.mirror and not self.staged:
+                with self.phase('clear'):
+                    self.log(self.clear_remote_path(self.soft))
+            with self.phase('remote_hash'):
+                if not self.check_remote_hash_command():
+                    return 'failed'
+                self.get_hash_remote_files()
+            first_install = not self.hash_remote
+            if self.staged and (self.clear or self.dict_differ(self.hash_local, self.hash_remote)
+                                or (self.mirror and self.dict_removed(self.hash_local, self.hash_remote))):
+                # изменения вносятся в копию каталога клиента, рабочий каталог переключается на неё после настройки
+                with self.phase('stage'):
+                    if not self.prepare_stage():
+                        return 'failed'
+                self.remote_path = f"{self.stage_path}/"
+                if self.clear and not self.mirror:
+                    with self.phase('clear'):
+                        self.log(self.clear_remote_path(self.soft))
+                    self.hash_remote = {}
+                    first_install = True
+            with self.phase('transfer'):
+                if not self.update_files():
+                    return 'failed'
+            if self.mirror:
+                with self.phase('delete'):
+                    if not self.remove_extraneous_files():
+                        return 'failed'
+            with self.phase('permissions'):
+                self.apply_permissions(full=first_install)
+            with self.phase('config_command'):
+                if self.config_command:
+                    self.log(self.ssh_run_command(self.config_command))
+            if self.stage_path:
+                self.remote_path = live_path
+                with self.phase('swap'):
+                    if not self.swap_release(self.stage_path):
+                        return 'failed'
+                    self.stage_path = None
+            if self.restart_command:
+                with self.phase('restart'):
+                    self.log(self.ssh_run_command(self.restart_command))
+            if self.remote_manifest:
+                with self.phase('manifest'):
+                    self.save_remote_manifest()
+        except (SSHException, socket.error, EOFError) as err:
+            self.log(f"Ошибка при обновлении сервера {mo.ipv4}: {err}")
+            return 'failed'
+        finally:
+            self.remote_path = live_path
+            if self.stage_path:
+                self.discard_stage()
+            if not self.pool:
+                self.ssh.close()
+        return 'succeeded' if self.files_copied or self.files_deleted else 'skipped'
+
+    def _rollback_host_worker(self, mo, throttle=None) -> tuple:
+        """
+        Возврат к предыдущему релизу в отдельном потоке
+        :param mo: строка из get_mo_data
+        :param throttle: не используется
+        :return: (mo, результат, вывод)
+        """
+        worker = copy.copy(self)
+        worker.ssh = None
+        worker.output = []
+        try:
+            status = worker.rollback_host(mo)
+        except Exception as err:
+            # ошибка одного хоста не прерывает обработку остальных, хост учитывается в итогах как failed
+            worker.log(f"Ошибка при возврате к предыдущему релизу на сервере {mo.ipv4}: {type(err).__name__}: {err}")
+            status = 'failed'
+        return mo, status, worker.output
+
+    def _update_host_worker(self, mo, throttle=None) -> tuple:
+        """
+        Обновление хоста в отдельном потоке. Для каждого хоста создаётся копия объекта со своим
+        подключением и буфером вывода, подсчитанные суммы локальных файлов общие для всех потоков
+        :param mo: строка из get_mo_data
+        :param throttle: TokenBucket ограничения скорости передачи района хоста
+        :return: (mo, результат обновления, вывод)
+        """
+        worker = copy.copy(self)
+        worker.throttle = throttle
+        relay_host = self.relays.get(mo.state)
+        worker.relay_host = relay_host if relay_host != mo.ipv4 else None
+        worker.ssh = None
+        worker.hash_remote = {}
+        worker.remote_listing = {}
+        worker.output = []
+        worker.host_metrics = None
+        try:
+            status = worker.update_host(mo)
+        except Exception as err:
+            # ошибка одного хоста не прерывает обновление остальных, хост учитывается в итогах как failed
+            worker.log(f"Ошибка при обновлении сервера {mo.ipv4}: {type(err).__name__}: {err}")
+            status = 'failed'
+            if worker.host_metrics:
+                worker.host_metrics.status = status
+        return mo, status, worker.output
+
+    def print_summary(self):
+        """
+        Вывод итогов обновления
+        """
+        print(f"\nИтог обновления: успешно {len(self.summary['succeeded'])}, "
+              f"с ошибками {len(self.summary['failed'])}, "
+              f"пропущено (клиент актуален) {len(self.summary['skipped'])}")
+        if self.summary['failed']:
+            print(f"Хосты с ошибками: {', '.join(self.summary['failed'])}")
+        if self.summary.get('aborted'):
+            print(f"Не обновлялись из-за ошибок пробной волны: {', '.join(self.summary['aborted'])}")
+        if self.metrics:
+            print(self.metrics.summary())
+
+    def write_metrics(self):
+        """
+        Выгрузка метрик запуска в файлы JSON lines и Prometheus, если они указаны
+        """
+        try:
+            if self.metrics_jsonl:
+                self.metrics.write_jsonl(self.metrics_jsonl)
+            if self.metrics_prom:
+                self.metrics.write_prometheus(self.metrics_prom)
+        except OSError as err:
+            print(f"Не удалось записать метрики: {err}")
+
+    def load_mo_data(self):
+        """
+        Загрузка списка хостов для обновления, если он не передан
         """
-        self.__setup()
-        self.get_hash_local_files()
         if not self.data_mo:
             if self.soft == 'mis':
                 self.data_mo = self.get_mo_data(server='TS')
@@ -272,20 +1035,83 @@ class UpdateFiles:
                 self.data_mo = self.get_mo_data(server='TS', iemk=True)
             elif self.soft == 'soap':
                 self.data_mo = self.get_mo_data(server='DB')
-        for mo in self.data_mo:
-            if not self.ssh_connect(ipv4=mo.ipv4):
-                continue
-            # mo = self.get_mo_data(ipaddr=ip)[0]
-            print(f"\nВыполняется обновление на сервере {mo.ipv4} в {mo.state} {mo.name}:")     # в {mo.state} {mo.name}
-            if self.clear:
-                print(self.clear_remote_path(self.soft))
-            self.get_hash_remote_files()
-            self.update_files()
-            print(self.ssh_run_command(self.config_command))
-            self.ssh.close()
+
+    def rollback(self):
+        """
+        Возврат к предыдущему релизу на хостах, обновлённых с подготовкой каталога (staged)
+        :return: словарь с IP адресами хостов по результатам
+        """
+        self.__setup()
+        self.load_mo_data()
+        self.summary = {'succeeded': [], 'failed': [], 'skipped': []}
+
+        def done(mo, result):
+            _, status, output = result
+            print('\n'.join(output))
+            self.summary[status].append(mo.ipv4)
+        RolloutScheduler(workers=self.workers, group_workers=self.group_workers).\
+            run(self.data_mo, group=lambda mo: mo.state, func=self._rollback_host_worker,
+                succeeded=lambda result: result[1] != 'failed', done=done)
+        self.print_summary()
+        return self.summary
+
+    def update(self):
+        """
+        Выполнение обновления файлов по списку указанных хостов. Хосты обновляются планировщиком
+        RolloutScheduler по районам: не более workers хостов одновременно, не более group_workers хостов
+        и group_rate байт/с на район, не более total_rate байт/с на все хосты; при canary > 0 остальные хосты обновляются после успешной пробной волны.
+        В режиме relay сначала обновляется первый хост каждого района, остальные хосты района получают
+        изменённые файлы с него. В режиме staged изменения вносятся в копию каталога клиента, рабочий каталог
+        переключается на неё заменой символической ссылки, возврат к предыдущему релизу - rollback()
+        :return: словарь с IP адресами хостов по результатам обновления
+        """
+        self.__setup()
+        # Неизвестный или недоступный алгоритм подсчёта сумм вызывает ValueError до подключения к хостам
+        remote_hash_command(self.hash_algorithm)
+        self.metrics = RolloutMetrics(self.soft)
+        with self.phase('local_hash'):
+            self.get_hash_local_files()
+        if self.transfer == 'bundle':
+            with self.phase('bundle'):
+                self.bundle = ReleaseBundle(self.local_path, self.hash_local, algorithm=self.hash_algorithm)
+                print(f"Собрано блоков релиза: {self.bundle.build(workers=self.hash_workers)}")
+        self.load_mo_data()
+        self.release_name = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        self.summary = {'succeeded': [], 'failed': [], 'skipped': []}
+
+        def done(mo, result):
+            _, status, output = result
+            print('\n'.join(output))
+            self.summary[status].append(mo.ipv4)
+        scheduler = RolloutScheduler(workers=self.workers, group_workers=self.group_workers,
+                                     group_rate=self.group_rate, canary=self.canary, total_rate=self.total_rate)
+        hosts = list(self.data_mo)
+        aborted = []
+        self.relays.clear()
+        if self.relay:
+            # первый хост района обновляется с локального хоста и становится источником для остальных хостов района
+            seeds = {}
+            for mo in hosts:
+                seeds.setdefault(mo.state, mo)
+            print(f"Обновление первых хостов районов: {len(seeds)}")
+            results = scheduler.run(seeds.values(), group=lambda mo: mo.state, func=self._update_host_worker,
+                                    succeeded=lambda result: result[1] != 'failed', done=done)
+            self.relays.update({mo.state: mo.ipv4 for mo, (_, status, _) in results if status != 'failed'})
+            seed_ids = {id(mo) for mo in seeds.values()}
+            hosts = [mo for mo in hosts if id(mo) not in seed_ids]
+            if scheduler.aborted:
+                aborted = scheduler.aborted + hosts
+                hosts = []
+            scheduler.canary = 0
+        scheduler.run(hosts, group=lambda mo: mo.state, func=self._update_host_worker,
+                      succeeded=lambda result: result[1] != 'failed', done=done)
+        self.summary['aborted'] = [mo.ipv4 for mo in aborted + scheduler.aborted]
+        self.print_summary()
+        self.write_metrics()
+        return self.summary
 
 
 if __name__ == '__main__':
     mo_data = UpdateFiles.get_mo_data(server='TS', iemk=True, ipaddr=['10.212.2.131', '10.235.11.131'])
-    data = UpdateFiles(software='iemk', data_mo=mo_data)
+    data = UpdateFiles(software='iemk', data_mo=mo_data, workers=4)
     data.update()
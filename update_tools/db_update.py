@@ -1,9 +1,20 @@
-import re
+import copy
+import csv
 import datetime
+import json
+import queue
+import sys
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from update_tools.models import *
+from update_tools.sql_parser import iter_statements, first_keyword, ReleaseCache
+from update_tools.scheduler import RolloutScheduler
+from update_tools.fleet_query import check_read_only, open_writer
 from sqlalchemy.exc import *
 import sqlalchemy.orm.exc
-from sqlalchemy import text
+from sqlalchemy import text, func
 import sqlalchemy.orm.session as sql_session
 
 HOST = settings.DB_HOST
@@ -14,15 +25,53 @@ DB = settings.DB_NAME
 DB_MO_LOGIN = settings.DB_MO_LOGIN
 DB_MO_DBNAME = settings.DB_MO_DBNAME
 
+FleetServer = namedtuple('FleetServer', ['id', 'ipv4', 'state', 'name', 'user', 'password'])
+# Запросы, которые могут выполняться пакетом: изменение данных без неявной фиксации транзакции
+BATCH_KEYWORDS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def statement_profile(index: int, query: str, duration: float, rows: int = None, result: bool = True,
+                      comment: str = None) -> dict:
+    """
+    Запись профиля выполнения запроса релиза для таблицы misupdate_logstatementdbmis
+    :param index: номер запроса в релизе, начиная с 0
+    :param query: текст запроса, сохраняются первые 500 символов
+    :param duration: время выполнения в секундах
+    :param rows: количество затронутых строк
+    :param result: запрос выполнен без ошибок
+    :param comment: текст ошибки
+    :return: словарь с полями таблицы
+    """
+    return {'statementIndex': index, 'statement': ' '.join(query.split())[:500], 'duration': duration,
+            'rowsAffected': rows, 'result': result, 'comment': comment[:500] if comment else comment}
+
 
 class DbUpdater:
-    def __init__(self, ipaddr: list = None, rel: list = None):
+    def __init__(self, ipaddr: list = None, rel: list = None, workers: int = 1, log_flush_size: int = 50,
+                 profile: bool = True, resume: bool = True, group_workers: int = None, canary: int = 0,
+                 batch_size: int = 1):
         self.releases = rel
         self.servers = ipaddr
         self.sql_queries = None
         self.session = None
         self.auth_data = None
         self.current_release = None
+        self.workers = workers
+        self.output = None
+        self.fleet = {}
+        self.release_ids = {}
+        self.logged = set()
+        self.log_entries = []
+        self.statement_entries = []
+        self.profile = profile
+        self.resume = resume
+        self.group_workers = group_workers
+        self.canary = canary
+        self.batch_size = batch_size
+        self.checkpoints = {}
+        self.log_flush_size = log_flush_size
+        self.log_lock = threading.Lock()
+        self.release_cache = ReleaseCache()
 
     @staticmethod
     def sql_parse(queries: str) -> list:
@@ -31,26 +80,12 @@ class DbUpdater:
         :param queries: строка
         :return: список запросов
         """
-        # Find special delimiters
-        delimiters = re.compile('DELIMITER *(\S*)', re.I)
-        result = delimiters.split(queries)
-
-        # Insert default delimiter and separate delimiters and sql
-        result.insert(0, ';')
-        delimiter = result[0::2]
-        section = result[1::2]
-        result_queries = []
+        return list(iter_statements(queries))
 
-        # Split queries on delimiters and execute
-        for i in range(len(delimiter)):
-            queries = section[i].split(delimiter[i])
-            result_queries.extend([query for query in queries if query.strip(' \r\n')])
-        return result_queries
-
-    @staticmethod
-    def get_installed_release(session: sql_session) -> list:
+    def get_installed_release(self, session: sql_session) -> list:
         """
-        Функция возвращает список установленных в МО обновлений
+        Функция возвращает список установленных в МО обновлений. Ошибка выводится через log,
+        при параллельном обновлении - в блоке вывода сервера
         :param session:
         :return: список установленных обновлений
         """
@@ -60,23 +95,119 @@ class DbUpdater:
             releases = [str(i[0]) for i in result]
             return releases
         except (sqlalchemy.orm.exc.NoResultFound, ProgrammingError, OperationalError) as err:
-            print(f'Ошибка при получении списка установленных обновлений: {err}\n')
+            self.log(f'Ошибка при получении списка установленных обновлений: {err}\n')
             return list()
 
     @staticmethod
-    def execute_sql_queries(session: sql_session, sql_queries: list):
+    def batch_length(sql_queries: list, start: int, batch_size: int) -> int:
+        """
+        Количество идущих подряд с номера start запросов, которые можно выполнить одним пакетом.
+        Тип запроса определяется по первому ключевому слову без учёта комментариев перед ним
+        :param sql_queries: список sql запросов
+        :param start: номер первого запроса
+        :param batch_size: максимальное количество запросов в пакете
+        :return: количество запросов, не менее 1
+        """
+        length = 0
+        for query in sql_queries[start:start + batch_size]:
+            if first_keyword(query) not in BATCH_KEYWORDS:
+                break
+            length += 1
+        return max(length, 1)
+
+    @staticmethod
+    def execute_batch(session: sql_session, sql_queries: list, start: int, length: int, profile: list = None,
+                      commit_each: bool = False):
         """
-        Функция выполняет запросы из обновления в МО
+        Выполнение запросов одним обращением к серверу (требуется подключение с multi_statements).
+        Результаты запросов читаются по очереди, ошибка сопоставляется с номером запроса в релизе.
+        Время выполнения пакета в профиле делится поровну между его запросами
         :param session:
         :param sql_queries: список sql запросов
+        :param start: номер первого запроса пакета
+        :param length: количество запросов в пакете
+        :param profile: список для профиля запросов
+        :param commit_each: фиксировать выполненные запросы пакета, в том числе предшествующие ошибочному
         :return:
         """
-        for query in sql_queries:
+        queries = sql_queries[start:start + length]
+        dbapi = session.get_bind().dialect.dbapi
+        cursor = session.connection().connection.cursor()
+        started = time.monotonic()
+        index = start
+        rows = []
+        try:
+            # разделитель на отдельной строке: запрос может заканчиваться однострочным комментарием
+            cursor.execute('\n;\n'.join(queries))
+            while True:
+                rows.append(cursor.rowcount if cursor.rowcount >= 0 else None)
+                index += 1
+                if index == start + length or not cursor.nextset():
+                    break
+        except dbapi.Error as orig:
+            err = DBAPIError.instance(sql_queries[index], None, orig, dbapi.Error)
+            if commit_each:
+                session.commit()
+            else:
+                session.rollback()
+            err.statement_index = index
+            if profile is not None:
+                duration = (time.monotonic() - started) / (index - start + 1)
+                profile.extend(statement_profile(start + i, sql_queries[start + i], duration, rows=count)
+                               for i, count in enumerate(rows))
+                profile.append(statement_profile(index, sql_queries[index], duration, result=False,
+                                                 comment=str(err.args[0])))
+            raise err
+        finally:
+            cursor.close()
+        if commit_each:
+            session.commit()
+        if profile is not None:
+            duration = (time.monotonic() - started) / length
+            profile.extend(statement_profile(start + i, sql_queries[start + i], duration, rows=count)
+                           for i, count in enumerate(rows))
+
+    @staticmethod
+    def execute_sql_queries(session: sql_session, sql_queries: list, profile: list = None, start: int = 0,
+                            commit_each: bool = False, batch_size: int = 1):
+        """
+        Функция выполняет запросы из обновления в МО. При ошибке номер запроса в релизе
+        сохраняется в атрибуте statement_index исключения
+        :param session:
+        :param sql_queries: список sql запросов
+        :param profile: список, в который добавляется профиль каждого выполненного запроса (statement_profile)
+        :param start: номер запроса, с которого начинается выполнение
+        :param commit_each: фиксировать каждый запрос (пакет запросов) отдельно, иначе все запросы фиксируются в конце
+        :param batch_size: максимальное количество идущих подряд INSERT, UPDATE, DELETE, REPLACE,
+        выполняемых одним обращением к серверу MySQL (execute_batch)
+        :return:
+        """
+        if session.get_bind().dialect.name != 'mysql':
+            batch_size = 1
+        index = start
+        while index < len(sql_queries):
+            length = DbUpdater.batch_length(sql_queries, index, batch_size) if batch_size > 1 else 1
+            if length > 1:
+                DbUpdater.execute_batch(session, sql_queries, index, length, profile, commit_each)
+                index += length
+                continue
+            query = sql_queries[index]
+            started = time.monotonic()
             try:
-                session.execute(text(query))
-            except (ProgrammingError, IntegrityError) as err:
+                result = session.execute(text(query))
+                if commit_each:
+                    session.commit()
+            except DBAPIError as err:
                 session.rollback()
+                err.statement_index = index
+                if profile is not None:
+                    profile.append(statement_profile(index, query, time.monotonic() - started, result=False,
+                                                     comment=str(err.args[0])))
                 raise err
+            if profile is not None:
+                profile.append(statement_profile(index, query, time.monotonic() - started,
+                                                 rows=result.rowcount if result.rowcount >= 0 else None))
+            index += 1
         session.commit()
 
     @staticmethod
@@ -89,46 +220,212 @@ class DbUpdater:
         #         print(err)
         return [f"{query}:\n{session.execute(text(query)).fetchall()}" for query in sql_queries]
 
+    def preload(self):
+        """
+        Загрузка данных о серверах, релизах и успешных обновлениях из БД обновлений в начале запуска:
+        id сервера, IP адрес, район и наименование МО, данные для авторизации; id релизов по версиям;
+        контрольные точки прерванных обновлений (при resume=True)
+        :return:
+        """
+        try:
+            rows = self.session.query(Servers.id, Servers.ipv4, Mo.state, Mo.name, Authdata.user, Authdata.password).\
+                join(Mo).outerjoin(Authdata, Authdata.server_id == Servers.id).\
+                filter(Servers.ipv4.in_(self.servers)).all()
+            self.fleet = {}
+            duplicates = set()
+            for row in rows:
+                if row.ipv4 in self.fleet:
+                    duplicates.add(row.ipv4)
+                self.fleet[row.ipv4] = FleetServer(*row)
+            for ipv4 in duplicates:
+                self.log(f"Для сервера {ipv4} найдено несколько записей с данными для авторизации")
+                self.fleet[ipv4] = self.fleet[ipv4]._replace(user=None, password=None)
+            self.release_ids = dict(self.session.query(Updatequeries.releaseVersion, Updatequeries.id).
+                                    filter(Updatequeries.releaseVersion.in_(self.releases)).all())
+            self.logged = set(self.session.query(Logupdatedbmis.host_id, Logupdatedbmis.release_id).
+                              filter(Logupdatedbmis.result == True,
+                                     Logupdatedbmis.release_id.in_(self.release_ids.values())).all())
+        except (OperationalError, ProgrammingError) as err:
+            self.log(f"Ошибка при загрузке данных о серверах и релизах: {err}")
+        self.checkpoints.clear()
+        if not self.resume:
+            return
+        try:
+            self.checkpoints.update({(row.host_id, row.release_id): (row.statementIndex, row.releaseHash) for row in
+                                     self.session.query(Checkpointdbmis.host_id, Checkpointdbmis.release_id,
+                                                        Checkpointdbmis.statementIndex, Checkpointdbmis.releaseHash).
+                                     filter(Checkpointdbmis.release_id.in_(self.release_ids.values())).all()})
+        except (OperationalError, ProgrammingError) as err:
+            # без контрольных точек релизы выполняются с начала
+            self.session.rollback()
+            self.log(f"Ошибка при загрузке контрольных точек обновления: {err}")
+
     def write_result_update_to_db(self, ipv4: str, result: bool, release: str, comment: str = 'Успешно'):
         """
-        Функция записывает результаты обновлений в БД
+        Функция добавляет результат обновления в очередь записи в БД. Запись в БД выполняется пакетно
+        при накоплении log_flush_size записей и по завершении запуска. Результат не записывается, если
+        обновление на сервере уже отмечено успешным
         :param ipv4: IP адрес сервера БД МО
         :param result: Результат обновления
         :param comment: Комментарий результата обновления
         :param release: Версия обновления
         :return:
         """
-        date = datetime.datetime.now()
-        try:
-            host_id = self.session.query(Servers.id).filter(Servers.ipv4 == ipv4).one()
-            release_id = self.session.query(Updatequeries.id).filter(Updatequeries.releaseVersion == release).one()
+        server = self.fleet.get(ipv4)
+        release_id = self.release_ids.get(release)
+        if server is None or release_id is None:
+            self.log(f"Ошибка при записи лога обновления: нет данных о сервере {ipv4} или релизе {release}")
+            return
+        with self.log_lock:
+            # запись о выполненном ранее успешном обновлении уже есть
+            if (server.id, release_id) in self.logged:
+                return
+            if result:
+                self.logged.add((server.id, release_id))
+            self.log_entries.append({'updateDate': datetime.datetime.now(), 'result': result, 'comment': comment,
+                                     'host_id': server.id, 'release_id': release_id})
+            flush = len(self.log_entries) >= self.log_flush_size
+        if flush:
+            self.flush_log_entries()
+
+    def write_statement_profile(self, ipv4: str, release: str, profile: list):
+        """
+        Добавляет профиль выполнения запросов релиза на сервере в очередь записи в БД,
+        записывается вместе с результатами обновлений
+        :param ipv4: IP адрес сервера БД МО
+        :param release: Версия обновления
+        :param profile: список записей statement_profile
+        :return:
+        """
+        server = self.fleet.get(ipv4)
+        release_id = self.release_ids.get(release)
+        if not profile or server is None or release_id is None:
+            return
+        update_date = datetime.datetime.now()
+        with self.log_lock:
+            self.statement_entries.extend(dict(entry, updateDate=update_date, host_id=server.id,
+                                               release_id=release_id) for entry in profile)
+            flush = len(self.statement_entries) >= self.log_flush_size
+        if flush:
+            self.flush_log_entries()
+
+    def flush_log_entries(self):
+        """
+        Пакетная запись накопленных результатов обновлений и профилей запросов в БД
+        :return:
+        """
+        with self.log_lock:
+            entries = list(self.log_entries)
+            self.log_entries.clear()
+            statements = list(self.statement_entries)
+            self.statement_entries.clear()
+        if entries:
             try:
-                # entry_already_exist получает результат попытки обновления, выполненной ранее, True|False
-                entry_already_exist = self.session.query(Logupdatedbmis.result). \
-                    filter(Logupdatedbmis.host_id == host_id.id, Logupdatedbmis.release_id == release_id.id). \
-                    order_by(Logupdatedbmis.updateDate).one()
-            except sqlalchemy.orm.exc.NoResultFound:
-                entry_already_exist = False
-            if not entry_already_exist:
-                ins = Logupdatedbmis(updateDate=date, result=result, comment=comment,
-                                     host_id=host_id.id, release_id=release_id.id)
-                self.session.add(ins)
-                self.session.commit()
-        except (OperationalError, ProgrammingError) as err:
-            print(f"Ошибка при записи лога обновления: {err}")
+                with DatabaseConnection() as session:
+                    session.bulk_insert_mappings(Logupdatedbmis, entries)
+                    session.commit()
+            except (OperationalError, ProgrammingError) as err:
+                self.log(f"Ошибка при записи лога обновления: {err}")
+        # профили записываются отдельной транзакцией: ошибка их записи не должна отменять запись лога обновления
+        if statements:
+            try:
+                with DatabaseConnection() as session:
+                    session.bulk_insert_mappings(Logstatementdbmis, statements)
+                    session.commit()
+            except DBAPIError as err:
+                self.log(f"Ошибка при записи профиля запросов: {err}")
 
-    def get_auth_data(self, ipv4: str):
+    def create_tables(self):
         """
-        Функция используется для получения данных для авторизации на сервере БД МО
+        Создание в БД обновлений отсутствующих таблиц, используемых при обновлении:
+        misupdate_logstatementdbmis (профиль запросов, при profile=True) и
+        misupdate_checkpointdbmis (контрольные точки, при resume=True)
+        :return:
+        """
+        tables = ([Logstatementdbmis] if self.profile else []) + ([Checkpointdbmis] if self.resume else [])
+        if not tables:
+            return
+        try:
+            create_tables(self.session, tables)
+        except DBAPIError as err:
+            self.log(f"Не удалось создать таблицы {', '.join(table.__tablename__ for table in tables)}: {err}")
+
+    def get_checkpoint(self, ipv4: str, release: str) -> int:
+        """
+        Возвращает номер запроса, с которого продолжается прерванное ранее обновление на сервере.
+        Контрольная точка не используется, если скрипт релиза изменился после её сохранения
+        :param ipv4: IP адрес сервера БД МО
+        :param release: Версия обновления
+        :return: номер первого невыполненного запроса, 0 - выполнять релиз с начала
+        """
+        server = self.fleet.get(ipv4)
+        release_id = self.release_ids.get(release)
+        if server is None or release_id is None:
+            return 0
+        with self.log_lock:
+            checkpoint = self.checkpoints.get((server.id, release_id))
+        if checkpoint is None:
+            return 0
+        index, digest = checkpoint
+        if digest != self.release_cache.digest(release):
+            self.log(f"Скрипт обновления {release} изменён после прерванного выполнения, выполняется с начала")
+            return 0
+        return index
+
+    def save_checkpoint(self, ipv4: str, release: str, index: int = None):
+        """
+        Сохраняет в БД обновлений номер первого невыполненного запроса релиза на сервере,
+        при index=None контрольная точка удаляется. Запись выполняется сразу, без накопления
         :param ipv4: IP адрес сервера БД МО
+        :param release: Версия обновления
+        :param index: номер первого невыполненного запроса
         :return:
         """
+        server = self.fleet.get(ipv4)
+        release_id = self.release_ids.get(release)
+        if server is None or release_id is None:
+            return
+        key = (server.id, release_id)
+        with self.log_lock:
+            if index is None and key not in self.checkpoints:
+                return
+        digest = self.release_cache.digest(release)
         try:
-            self.auth_data = self.session.query(Authdata.user, Authdata.password).join(Servers).filter(Servers.ipv4 == ipv4).one()
-        except(OperationalError, ProgrammingError,
-               sqlalchemy.orm.exc.NoResultFound, sqlalchemy.orm.exc.MultipleResultsFound) as err:
-            print(f"Ошибка при получении данных для авторизации на сервере {ipv4}: {err}")
+            with DatabaseConnection() as session:
+                checkpoint = session.query(Checkpointdbmis).filter(Checkpointdbmis.host_id == server.id,
+                                                                   Checkpointdbmis.release_id == release_id).first()
+                if index is None:
+                    if checkpoint is not None:
+                        session.delete(checkpoint)
+                else:
+                    if checkpoint is None:
+                        checkpoint = Checkpointdbmis(host_id=server.id, release_id=release_id)
+                        session.add(checkpoint)
+                    checkpoint.statementIndex = index
+                    checkpoint.releaseHash = digest
+                    checkpoint.updateDate = datetime.datetime.now()
+                session.commit()
+        except (OperationalError, ProgrammingError, IntegrityError) as err:
+            self.log(f"Ошибка при сохранении контрольной точки обновления {release} на сервере {ipv4}: {err}")
+            return
+        with self.log_lock:
+            if index is None:
+                self.checkpoints.pop(key, None)
+            else:
+                self.checkpoints[key] = (index, digest)
+
+    def get_auth_data(self, ipv4: str):
+        """
+        Функция используется для получения данных для авторизации на сервере БД МО из загруженных в preload данных
+        :param ipv4: IP адрес сервера БД МО
+        :return:
+        """
+        server = self.fleet.get(ipv4)
+        if server is None or server.user is None:
+            self.log(f"Ошибка при получении данных для авторизации на сервере {ipv4}: данные не найдены")
             self.auth_data = None
+        else:
+            self.auth_data = server
         return self.auth_data
 
     def get_servers_ip(self) -> list:
@@ -162,119 +459,429 @@ class DbUpdater:
 
     def get_queries(self, release: str):
         """
-        Функция получения SQL запросов указанного в параметрах релиза.
+        Функция получения SQL запросов указанного в параметрах релиза. Разобранные запросы берутся из кэша,
+        общего для всех серверов запуска, скрипт релиза загружается и разбирается только при первом обращении
         :param release: Версия релиза
         :return:
         """
+        self.sql_queries = self.release_cache.get(release)
+        if self.sql_queries is not None:
+            self.current_release = release
+            return
         try:
             res = self.session.query(Updatequeries.releaseVersion, Updatequeries.sqlQuery).\
                 filter(Updatequeries.releaseVersion == release).one()
-            self.sql_queries = self.sql_parse(res.sqlQuery)
+            self.sql_queries = self.release_cache.put(res.releaseVersion, res.sqlQuery)
             self.current_release = res.releaseVersion
         except (OperationalError, ProgrammingError, sqlalchemy.orm.exc.NoResultFound) as err:
-            print(f"Не удалось получить список запросов для обновления: {err}")
+            self.log(f"Не удалось получить список запросов для обновления: {err}")
             self.sql_queries = None
 
+    def log(self, *args):
+        """
+        Вывод сообщения. При параллельном обновлении сообщения накапливаются в буфере сервера
+        и выводятся одним блоком после завершения обновления на нём
+        """
+        if self.output is None:
+            print(*args)
+        else:
+            self.output.append(' '.join(str(arg) for arg in args))
+
     def __set_param(self):
+        # кэш разобранных релизов создаётся на каждый запуск: скрипт релиза мог измениться после предыдущего
+        self.release_cache = ReleaseCache()
+        self.sql_queries = None
+        self.current_release = None
         if not self.releases:
             self.get_all_release()
         if not self.servers:
             self.servers = self.get_servers_ip()
+        self.preload()
+
+    def reconcile_server(self, server: str, release_rows: list):
+        """
+        Записывает на сервер БД МО информацию о всех отсутствующих в update_base релизах одной транзакцией
+        :param server: адрес сервера БД
+        :param release_rows: строки Updatequeries релизов запуска
+        :return:
+        """
+        if not self.get_auth_data(ipv4=server):
+            return
+        with DatabaseConnection(user=self.auth_data.user, password=self.auth_data.password,
+                                host=server, db_name='s11') as mo_db_session:
+            try:
+                installed_releases = {str(row[0]) for row in
+                                      mo_db_session.execute(text("SELECT release_version FROM update_base"))}
+            except DBAPIError as err:
+                mo_db_session.rollback()
+                self.log(f"Ошибка при получении списка установленных обновлений на сервере {server}: {err}")
+                return
+            missing = [row for row in release_rows if row.releaseVersion not in installed_releases]
+            if not missing:
+                self.log(f"Все обновления на сервере {server} уже установлены")
+                return
+            try:
+                mo_db_session.execute(text("INSERT INTO update_base (release_date, release_version) "
+                                           "VALUES (:release_date, :release_version)"),
+                                      [{'release_date': row.releaseDate, 'release_version': row.releaseVersion}
+                                       for row in missing])
+                mo_db_session.execute(text("INSERT INTO update_base_contents (base_release_version, comment, "
+                                           "source, visible) VALUES (:release_version, :comment, :source, :visible)"),
+                                      [{'release_version': row.releaseVersion, 'comment': row.comments,
+                                        'source': row.manual, 'visible': row.visible} for row in missing])
+                mo_db_session.commit()
+            except DBAPIError as err:
+                mo_db_session.rollback()
+                self.log(f"Не удалось выполнить запрос в МО {server}:\n{err}")
+                return
+        for row in missing:
+            self.write_result_update_to_db(ipv4=server, result=True, comment="Выполнено вне системы",
+                                           release=row.releaseVersion)
+        self.log(f"Запись выполнена. Сервер: {server}, релизы: {', '.join(row.releaseVersion for row in missing)}")
 
     def insert_update_base_and_contents(self):
         """
         Пишем информацию о релизе в таблицы: update_base и update_base_contents
         на тот случай, если скрипты из обновления прогнали руками.
-        :param ipv4: адрес сервера БД
-        :param release: версия обновления
+        Данные о релизах загружаются один раз, на каждом сервере отсутствующие релизы записываются одной транзакцией,
+        ошибка на одном сервере не прерывает обработку остальных
         :return:
         """
         with DatabaseConnection() as self.session:
             self.__set_param()
-            for server in self.servers:
-                for release in self.releases:
-                    try:
-                        res = self.session.query(Updatequeries).filter(Updatequeries.releaseVersion == release).one()
-                    except sqlalchemy.orm.exc.NoResultFound as err:
-                        print(f"В БД информации о версии обновления {release} не найдено: {err}")
-                        continue
-                    except (OperationalError, ProgrammingError) as err:
-                        print(f"Ошибка при получении данных из БД: {err}")
-                        continue
-                    self.get_auth_data(ipv4=server)
-                    with DatabaseConnection(user=self.auth_data.user, password=self.auth_data.password,
-                                            host=server, db_name='s11') as mo_db_session:
-                        installed_releases = self.get_installed_release(mo_db_session)
-                        if release not in installed_releases:
-                            sql1 = text(f"INSERT INTO update_base (release_date, release_version) VALUES "
-                                        f"('{res.releaseDate}', {res.releaseVersion});")
-                            sql2 = text(f"INSERT INTO update_base_contents (base_release_version, comment, "
-                                        f"source, visible) VALUES ({res.releaseVersion}, '{res.comments}', "
-                                        f"'{res.manual}', {res.visible})")
-                            try:
-                                mo_db_session.execute(sql1)
-                                mo_db_session.execute(sql2)
-                                mo_db_session.commit()
-                                print(f"Запись выполнена. Сервер: {server}, релиз: {release}")
-                                self.write_result_update_to_db(ipv4=server, result=True,
-                                                               comment="Выполнено вне системы", release=release)
-                            except (OperationalError, IntegrityError) as err:
-                                print(f"Не удалось выполнить запрос в МО:\n{err}")
-                                return
-                        else:
-                            print(f"Обновление {release} на сервере {server} уже установлено")
+            try:
+                release_rows = self.session.query(Updatequeries).\
+                    filter(Updatequeries.releaseVersion.in_(self.releases)).order_by(Updatequeries.releaseVersion).all()
+            except (OperationalError, ProgrammingError) as err:
+                self.log(f"Ошибка при получении данных из БД: {err}")
+                return
+            not_found = set(self.releases) - {row.releaseVersion for row in release_rows}
+            if not_found:
+                self.log(f"В БД информации о версиях обновления {', '.join(sorted(not_found))} не найдено")
+            try:
+                for server in self.servers:
+                    self.reconcile_server(server, release_rows)
+            finally:
+                self.flush_log_entries()
+
+    def update_server(self, server: str) -> bool:
+        """
+        Выполняет обновление БД на одном сервере МО
+        :param server: IP адрес сервера БД МО
+        :return: True - все релизы установлены или версия базы данных актуальна
+        """
+        self.log(f"Сервер: {server}")
+        if not self.get_auth_data(ipv4=server):
+            return False
+        with DatabaseConnection(host=server, user=self.auth_data.user, password=self.auth_data.password,
+                                db_name='s11', multi_statements=self.batch_size > 1) as db_mo_session:
+            install_released = self.get_installed_release(db_mo_session)
+            if not install_released:
+                return False
+            release_for_update = sorted(list(set(self.releases) - set(install_released)))
+            if not release_for_update:
+                self.log("Версия базы данных актуальна.\n")
+                return True
+            for release in release_for_update:
+                if release != self.current_release:
+                    self.get_queries(release=release)
+                if self.sql_queries is None:
+                    return False
+                profile = [] if self.profile else None
+                start = self.get_checkpoint(server, release) if self.resume else 0
+                if start:
+                    self.log(f"Обновление {release} продолжается с запроса {start + 1} из {len(self.sql_queries)}")
+                try:
+                    self.execute_sql_queries(db_mo_session, sql_queries=self.sql_queries, profile=profile,
+                                             start=start, commit_each=self.resume, batch_size=self.batch_size)
+                except DBAPIError as err:
+                    # любая ошибка запроса (в том числе OperationalError, DataError, InternalError)
+                    # записывается в лог обновления, остальные релизы сервера не выполняются
+                    index = getattr(err, 'statement_index', None)
+                    if self.resume and index is not None:
+                        self.save_checkpoint(server, release, index or None)
+                    where = f"в запросе {index + 1} из {len(self.sql_queries)}" if index is not None \
+                        else "при фиксации изменений"
+                    self.write_result_update_to_db(ipv4=server, result=False, release=release,
+                                                   comment=f"Ошибка {where}: {err.args[0]}")
+                    self.log(f"Обновление {release} не выполнено.\nОшибка {where}:\n{err.args[0]}\n")
+                    return False
+                else:
+                    self.save_checkpoint(server, release)
+                    self.write_result_update_to_db(ipv4=server, result=True, release=release)
+                    self.log(f"Обновление {release} выполнено.\n")
+                finally:
+                    self.write_statement_profile(server, release, profile)
+        return True
+
+    def _update_server_worker(self, server: str, throttle=None) -> tuple:
+        """
+        Обновление сервера в отдельном потоке. Для каждого сервера создаётся копия объекта
+        со своей сессией к БД обновлений, своими разобранными запросами релиза и буфером вывода
+        :param server: IP адрес сервера БД МО
+        :param throttle: не используется, объём данных запросов не ограничивается
+        :return: (результат обновления, вывод обновления сервера)
+        """
+        worker = copy.copy(self)
+        worker.sql_queries = None
+        worker.current_release = None
+        worker.auth_data = None
+        worker.output = []
+        try:
+            with DatabaseConnection() as worker.session:
+                success = worker.update_server(server)
+        except Exception as err:
+            # ошибка одного сервера (подключение, данные для авторизации и т.п.) не прерывает обновление остальных
+            worker.log(f"Ошибка при обновлении сервера {server}: {type(err).__name__}: {err}")
+            success = False
+        return success, worker.output
 
     def update(self):
         """
-        Выполняет обновление БД в МО
+        Выполняет обновление БД в МО. Серверы обновляются планировщиком RolloutScheduler по районам:
+        не более workers серверов одновременно и не более group_workers серверов района;
+        при canary > 0 остальные серверы обновляются после успешного обновления пробной волны
         :return:
         """
         with DatabaseConnection() as self.session:
+            self.create_tables()
             self.__set_param()
-            for server in self.servers:
-                print(f"Сервер: {server}")
-                if not self.get_auth_data(ipv4=server):
-                    continue
-                with DatabaseConnection(host=server, user=self.auth_data.user,
-                                        password=self.auth_data.password, db_name='s11') as db_mo_session:
-                    install_released = self.get_installed_release(db_mo_session)
-                    if not install_released:
-                        continue
-                    release_for_update = sorted(list(set(self.releases) - set(install_released)))
-                    if not release_for_update:
-                        print("Версия базы данных актуальна.\n")
-                        continue
-                    for release in release_for_update:
-                        if release != self.current_release:
-                            self.get_queries(release=release)
-                        try:
-                            self.execute_sql_queries(db_mo_session, sql_queries=self.sql_queries)
-                        except (ProgrammingError, IntegrityError) as err:
-                            self.write_result_update_to_db(ipv4=server, result=False,
-                                                           release=release, comment=err.args[0])
-                            print(f"Обновление {release} не выполнено.\nОшибка:\n{err.args[0]}\n")
-                            break
-                        else:
-                            self.write_result_update_to_db(ipv4=server, result=True, release=release)
-                            print(f"Обновление {release} выполнено.\n")
-
-    def select(self):
-        SQL = ["SHOW VARIABLES WHERE Variable_name = 'hostname';", "SELECT organization FROM mo_odli;"]
+        scheduler = RolloutScheduler(workers=self.workers, group_workers=self.group_workers, canary=self.canary)
+        try:
+            scheduler.run(self.servers, group=lambda server: getattr(self.fleet.get(server), 'state', None),
+                          func=self._update_server_worker, succeeded=lambda result: result[0],
+                          done=lambda server, result: print('\n'.join(result[1])))
+        finally:
+            self.flush_log_entries()
+        if scheduler.aborted:
+            print(f"Не обновлялись из-за ошибок пробной волны: {', '.join(scheduler.aborted)}")
+
+    def _inventory_server(self, server: str) -> dict:
+        """
+        Получение списка установленных обновлений на сервере БД МО без изменения данных
+        :param server: IP адрес сервера БД МО
+        :return: словарь с данными сервера, установленными релизами, временем ответа и ошибкой
+        """
+        fleet_server = self.fleet.get(server)
+        result = {'server': server, 'state': fleet_server.state if fleet_server else None,
+                  'mo': fleet_server.name if fleet_server else None, 'elapsed': None, 'installed': None, 'error': None}
+        if fleet_server is None or fleet_server.user is None:
+            result['error'] = 'Нет данных для авторизации'
+            return result
+        start = time.monotonic()
+        try:
+            with DatabaseConnection(host=server, user=fleet_server.user,
+                                    password=fleet_server.password, db_name='s11') as db_mo_session:
+                rows = db_mo_session.execute(text("SELECT release_version FROM update_base")).fetchall()
+                result['installed'] = sorted(str(row[0]) for row in rows)
+        except SQLAlchemyError as err:
+            result['error'] = str(err.args[0])
+        result['elapsed'] = round(time.monotonic() - start, 3)
+        return result
+
+    def plan(self, output: str = None, fmt: str = 'json', workers: int = None) -> list:
+        """
+        Формирует план обновления без изменения данных: для каждого сервера - установленные и ожидающие
+        установки релизы и время ответа сервера. Серверы опрашиваются параллельно, по умолчанию все сразу,
+        время формирования плана - время ответа самого медленного сервера
+        :param output: путь к файлу для записи плана, если не указан - вывод в stdout
+        :param fmt: формат: json или csv
+        :param workers: ограничение количества одновременно опрашиваемых серверов, по умолчанию - все серверы
+        :return: список словарей с данными серверов
+        """
         with DatabaseConnection() as self.session:
             self.__set_param()
-            for server in self.servers:
-                print(f"Сервер: {server}")
-                if not self.get_auth_data(ipv4=server):
-                    continue
-                with DatabaseConnection(host=server, user=self.auth_data.user,
-                                        password=self.auth_data.password, db_name='s11') as db_mo_session:
-                    results = self.execute_select_query(db_mo_session, sql_queries=SQL)
-                    for result in results:
-                        print(f"{result}\n")
+        releases = sorted(self.releases)
+        with ThreadPoolExecutor(max_workers=max(1, min(workers or len(self.servers), len(self.servers)))) as executor:
+            inventory = list(executor.map(self._inventory_server, self.servers))
+        for item in inventory:
+            installed = set(item['installed'] or [])
+            item['pending'] = [release for release in releases if release not in installed] \
+                if item['installed'] is not None else None
+        stream = open(output, 'w', encoding='utf-8', newline='') if output else sys.stdout
+        try:
+            if fmt == 'csv':
+                writer = csv.writer(stream)
+                writer.writerow(['server', 'state', 'mo', 'elapsed', 'error'] + releases)
+                for item in inventory:
+                    statuses = ['' if item['installed'] is None else
+                                'installed' if release in item['installed'] else 'pending' for release in releases]
+                    writer.writerow([item['server'], item['state'], item['mo'], item['elapsed'], item['error']]
+                                    + statuses)
+            else:
+                json.dump({'releases': releases, 'servers': inventory}, stream, ensure_ascii=False, indent=2)
+                stream.write('\n')
+        finally:
+            if output:
+                stream.close()
+        return inventory
+
+    def slowest_statements(self, limit: int = 20, releases: list = None) -> list:
+        """
+        Самые медленные запросы релизов по всем серверам по данным misupdate_logstatementdbmis
+        :param limit: количество запросов
+        :param releases: версии релизов, если не указаны - все релизы
+        :return: список словарей: релиз, номер запроса, текст, количество серверов, среднее и максимальное время
+        """
+        with DatabaseConnection() as self.session:
+            query = self.session.query(Updatequeries.releaseVersion, Logstatementdbmis.statementIndex,
+                                       func.max(Logstatementdbmis.statement),
+                                       func.count(func.distinct(Logstatementdbmis.host_id)),
+                                       func.avg(Logstatementdbmis.duration), func.max(Logstatementdbmis.duration)).\
+                join(Updatequeries, Updatequeries.id == Logstatementdbmis.release_id).\
+                filter(Logstatementdbmis.result == True)
+            if releases:
+                query = query.filter(Updatequeries.releaseVersion.in_(releases))
+            rows = query.group_by(Updatequeries.releaseVersion, Logstatementdbmis.statementIndex).\
+                order_by(func.max(Logstatementdbmis.duration).desc()).limit(limit).all()
+        statements = [{'release': row[0], 'index': row[1] + 1, 'statement': row[2], 'servers': row[3],
+                       'avg': round(row[4], 3), 'max': round(row[5], 3)} for row in rows]
+        for item in statements:
+            print(f"{item['release']} #{item['index']}: max {item['max']} с, avg {item['avg']} с, "
+                  f"серверов {item['servers']}\n{item['statement']}")
+        return statements
+
+    def heavy_releases(self, threshold: float = 600, releases: list = None) -> dict:
+        """
+        Оценка времени выполнения релизов по серверам, на которых они уже выполнены. Релиз считается
+        тяжёлым, если хотя бы на одном сервере суммарное время его запросов превысило порог
+        :param threshold: порог в секундах
+        :param releases: версии релизов, если не указаны - все релизы
+        :return: словарь релиз: {'servers', 'max', 'heavy'}
+        """
+        with DatabaseConnection() as self.session:
+            query = self.session.query(Updatequeries.releaseVersion, Logstatementdbmis.host_id,
+                                       func.sum(Logstatementdbmis.duration)).\
+                join(Updatequeries, Updatequeries.id == Logstatementdbmis.release_id)
+            if releases:
+                query = query.filter(Updatequeries.releaseVersion.in_(releases))
+            rows = query.group_by(Updatequeries.releaseVersion, Logstatementdbmis.host_id).all()
+        result = {}
+        for release, _, duration in rows:
+            item = result.setdefault(release, {'servers': 0, 'max': 0.0, 'heavy': False})
+            item['servers'] += 1
+            item['max'] = round(max(item['max'], duration), 3)
+            item['heavy'] = item['max'] > threshold
+        for release, item in sorted(result.items()):
+            print(f"{release}: максимум {item['max']} с на {item['servers']} серверах"
+                  f"{' - тяжёлый релиз' if item['heavy'] else ''}")
+        return result
+
+    def _query_server(self, server: str, sql: str, batches: queue.Queue, batch_size: int,
+                      stop: threading.Event = None) -> dict:
+        """
+        Выполнение запроса на чтение на сервере БД МО. Строки читаются курсором на стороне сервера
+        пачками по batch_size и передаются в очередь записи вместе с данными сервера.
+        Запрос передаётся драйверу без обработки параметров (:имя и % внутри строк не изменяются)
+        :param server: IP адрес сервера БД МО
+        :param sql: запрос
+        :param batches: очередь пачек строк (данные сервера, столбцы, строки)
+        :param batch_size: количество строк в пачке
+        :param stop: событие прекращения чтения строк (ошибка записи результата)
+        :return: словарь с данными сервера, количеством строк, временем выполнения и ошибкой
+        """
+        fleet_server = self.fleet.get(server)
+        tags = {'server': server, 'state': fleet_server.state if fleet_server else None,
+                'mo': fleet_server.name if fleet_server else None}
+        result = dict(tags, rows=0, elapsed=None, error=None)
+        if fleet_server is None or fleet_server.user is None:
+            result['error'] = 'Нет данных для авторизации'
+            return result
+        start = time.monotonic()
+        try:
+            with DatabaseConnection(host=server, user=fleet_server.user,
+                                    password=fleet_server.password, db_name='s11') as db_mo_session:
+                connection = db_mo_session.connection()
+                if connection.dialect.name == 'mysql':
+                    connection.execute(text("START TRANSACTION READ ONLY"))
+                rows = connection.execution_options(stream_results=True, no_parameters=True).exec_driver_sql(sql)
+                columns = list(rows.keys())
+                while batch := rows.fetchmany(batch_size):
+                    if stop is not None and stop.is_set():
+                        result['error'] = 'Чтение прервано'
+                        break
+                    batches.put((tags, columns, [tuple(row) for row in batch]))
+                    result['rows'] += len(batch)
+                db_mo_session.rollback()
+        except SQLAlchemyError as err:
+            result['error'] = str(err.args[0])
+        result['elapsed'] = round(time.monotonic() - start, 3)
+        return result
+
+    def query(self, sql: str, output: str = None, fmt: str = 'jsonl', workers: int = 32,
+              batch_size: int = 1000) -> list:
+        """
+        Выполнение запроса на чтение на серверах БД МО. Серверы опрашиваются параллельно, строки результата
+        не накапливаются в памяти, а по мере получения записываются в файл с IP адресом сервера, районом и МО
+        :param sql: запрос на чтение (SELECT, SHOW, DESCRIBE, EXPLAIN, WITH)
+        :param output: путь к файлу результата, если не указан - вывод в stdout
+        :param fmt: формат: jsonl, csv или parquet (требуется pyarrow)
+        :param workers: количество одновременно опрашиваемых серверов
+        :param batch_size: количество строк, читаемых с сервера за одно обращение
+        :return: список словарей с данными серверов, количеством строк, временем выполнения и ошибкой
+        """
+        sql = check_read_only(sql)
+        writer = open_writer(fmt, output)
+        with DatabaseConnection() as self.session:
+            self.__set_param()
+        batches = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+
+        def run(server):
+            try:
+                return self._query_server(server, sql, batches, batch_size, stop)
+            finally:
+                batches.put(None)
+        write_errors = {}
+        failure = None
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(self.servers)))) as executor:
+                futures = [executor.submit(run, server) for server in self.servers]
+                finished = 0
+                # очередь читается до завершения всех потоков, иначе они ожидают места в очереди бесконечно
+                while finished < len(futures):
+                    batch = batches.get()
+                    if batch is None:
+                        finished += 1
+                        continue
+                    if failure is not None:
+                        continue
+                    try:
+                        writer.write(*batch)
+                    except (ValueError, TypeError) as err:
+                        write_errors.setdefault(batch[0]['server'], f"Ошибка записи результата: {err}")
+                    except Exception as err:
+                        # запись невозможна (закрыт канал вывода, нет места на диске): чтение прекращается
+                        failure = err
+                        stop.set()
+                results = [future.result() for future in futures]
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                if failure is None:
+                    raise
+        if failure is not None:
+            raise failure
+        for result in results:
+            result['error'] = result['error'] or write_errors.get(result['server'])
+            status = f"ошибка: {result['error']}" if result['error'] else f"строк {result['rows']}"
+            print(f"Сервер {result['server']} {result['state'] or ''} {result['mo'] or ''}: {status}, "
+                  f"{result['elapsed']} с", file=sys.stderr)
+        return results
+
+    def select(self, sql: list = None, fmt: str = 'jsonl'):
+        """
+        Выполнение запросов на чтение на серверах БД МО с выводом результата в stdout
+        :param sql: список запросов, по умолчанию - имя хоста сервера и наименование организации
+        :param fmt: формат вывода: jsonl или csv
+        """
+        for query in sql or ["SHOW VARIABLES WHERE Variable_name = 'hostname';", "SELECT organization FROM mo_odli;"]:
+            self.query(query, fmt=fmt)
 
 
 if __name__ == '__main__':
     ipaddr = ['10.239.1.130']
     rel = ['2021030501']
-    dbupdater = DbUpdater(ipaddr=ipaddr, rel=rel)
+    dbupdater = DbUpdater(ipaddr=ipaddr, rel=rel, workers=4)
     dbupdater.update()
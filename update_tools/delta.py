@@ -0,0 +1,137 @@
+import hashlib
+import itertools
+import shlex
+import struct
+import zlib
+
+BLOCK_SIZE = 16384
+REMOTE_PYTHON = 'python3'
+MOD = 1 << 16
+
+# Скрипты на удалённом хосте должны выполняться python 3.6 и новее
+# Скрипт на удалённом хосте: выводит слабую и сильную суммы каждого блока файла
+REMOTE_SIGNATURE_SCRIPT = '''
+import hashlib, itertools, sys
+path, size = sys.argv[1], int(sys.argv[2])
+with open(path, "rb") as fn:
+    for block in iter(lambda: fn.read(size), b""):
+        a = sum(block) % 65536
+        b = sum(itertools.accumulate(block)) % 65536
+        print(a | b << 16, hashlib.md5(block).hexdigest())
+'''
+
+# Скрипт на удалённом хосте: собирает новый файл из блоков старого и переданных данных
+REMOTE_PATCH_SCRIPT = '''
+import os, shutil, struct, sys, zlib
+path, size = sys.argv[1], int(sys.argv[2])
+stream, tmp = sys.stdin.buffer, path + ".delta.tmp"
+with open(path, "rb") as old, open(tmp, "wb") as new:
+    for op in iter(lambda: stream.read(1), b""):
+        if op == b"C":
+            old.seek(struct.unpack(">Q", stream.read(8))[0] * size)
+            new.write(old.read(size))
+        else:
+            new.write(zlib.decompress(stream.read(struct.unpack(">I", stream.read(4))[0])))
+shutil.copymode(path, tmp)
+os.replace(tmp, path)
+'''
+
+
+def signature_command(path: str, block_size: int = BLOCK_SIZE) -> str:
+    """
+    Команда получения сумм блоков файла на удалённом хосте
+    :param path: путь к файлу на удалённом хосте
+    :param block_size: размер блока
+    :return: команда
+    """
+    return f"{REMOTE_PYTHON} -c {shlex.quote(REMOTE_SIGNATURE_SCRIPT)} {shlex.quote(path)} {block_size}"
+
+
+def patch_command(path: str, block_size: int = BLOCK_SIZE) -> str:
+    """
+    Команда сборки файла на удалённом хосте из переданного на stdin набора инструкций
+    :param path: путь к файлу на удалённом хосте
+    :param block_size: размер блока
+    :return: команда
+    """
+    return f"{REMOTE_PYTHON} -c {shlex.quote(REMOTE_PATCH_SCRIPT)} {shlex.quote(path)} {block_size}"
+
+
+def parse_signature(lines) -> dict:
+    """
+    Разбор вывода скрипта REMOTE_SIGNATURE_SCRIPT
+    :param lines: итератор строк
+    :return: словарь {слабая сумма: {сильная сумма: номер блока}}
+    """
+    signature = {}
+    for index, line in enumerate(lines):
+        weak, strong = line.split()
+        signature.setdefault(int(weak), {}).setdefault(strong, index)
+    return signature
+
+
+def weak_checksum(block: bytes) -> tuple:
+    """
+    Слабая сумма блока (как в rsync), допускающая пересчёт при сдвиге окна на один байт
+    :param block: данные блока
+    :return: (a, b)
+    """
+    return sum(block) % MOD, sum(itertools.accumulate(block)) % MOD
+
+
+def compute_delta(data: bytes, signature: dict, block_size: int = BLOCK_SIZE, max_literal: float = 0.5):
+    """
+    Формирование набора инструкций для сборки нового файла из блоков старого файла на удалённом хосте.
+    Инструкция C - копировать блок старого файла, D - вставить переданные данные (сжатые zlib)
+    :param data: содержимое нового файла
+    :param signature: суммы блоков старого файла, результат parse_signature
+    :param block_size: размер блока
+    :param max_literal: доля передаваемых данных, при превышении которой передача разницы не выгодна
+    :return: список инструкций или None, если файл выгоднее передать целиком
+    """
+    ops = []
+    literal_start = 0
+    literal_total = 0
+    limit = len(data) * max_literal
+
+    def flush_literal(end):
+        nonlocal literal_total
+        if end > literal_start:
+            chunk = zlib.compress(data[literal_start:end])
+            ops.append(b'D' + struct.pack('>I', len(chunk)) + chunk)
+            literal_total += end - literal_start
+
+    pos = 0
+    a, b = weak_checksum(data[pos:pos + block_size])
+    while pos + block_size <= len(data):
+        strong_blocks = signature.get(a | b << 16)
+        if strong_blocks:
+            index = strong_blocks.get(hashlib.md5(data[pos:pos + block_size]).hexdigest())
+            if index is not None:
+                flush_literal(pos)
+                ops.append(b'C' + struct.pack('>Q', index))
+                pos += block_size
+                literal_start = pos
+                a, b = weak_checksum(data[pos:pos + block_size])
+                continue
+        if literal_total + pos - literal_start > limit:
+            return None
+        # сдвиг окна на один байт
+        out_byte = data[pos]
+        in_byte = data[pos + block_size] if pos + block_size < len(data) else 0
+        a = (a - out_byte + in_byte) % MOD
+        b = (b - block_size * out_byte + a) % MOD
+        pos += 1
+    # хвост файла короче блока может совпасть с последним блоком старого файла
+    tail = data[pos:]
+    if tail:
+        tail_a, tail_b = weak_checksum(tail)
+        index = signature.get(tail_a | tail_b << 16, {}).get(hashlib.md5(tail).hexdigest())
+        if index is not None:
+            flush_literal(pos)
+            ops.append(b'C' + struct.pack('>Q', index))
+            literal_start = len(data)
+    flush_literal(len(data))
+    if literal_total > limit:
+        return None
+    return ops
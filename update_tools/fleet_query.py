@@ -0,0 +1,118 @@
+import csv
+import json
+import sys
+from update_tools.sql_parser import iter_statements, first_keyword
+
+# Запросы, разрешённые для выполнения на серверах МО
+READ_ONLY_KEYWORDS = ('SELECT', 'SHOW', 'DESCRIBE', 'DESC', 'EXPLAIN', 'WITH')
+# Поля, добавляемые к каждой строке результата
+TAG_COLUMNS = ('server', 'state', 'mo')
+
+
+def check_read_only(sql: str) -> str:
+    """
+    Проверка, что скрипт состоит из одного запроса на чтение. Комментарии перед запросом допускаются
+    :param sql: текст запроса
+    :return: запрос без завершающего разделителя
+    """
+    statements = list(iter_statements(sql))
+    if len(statements) != 1:
+        raise ValueError(f"Ожидается один запрос, получено: {len(statements)}")
+    statement = statements[0]
+    keyword = first_keyword(statement)
+    if keyword not in READ_ONLY_KEYWORDS:
+        raise ValueError(f"Разрешены только запросы на чтение ({', '.join(READ_ONLY_KEYWORDS)}): {keyword}")
+    return statement
+
+
+class JsonlWriter:
+    """
+    Запись строк результата в JSON lines, строка результата - объект JSON
+    """
+    def __init__(self, output: str = None):
+        self.stream = open(output, 'w', encoding='utf-8') if output else sys.stdout
+        self.output = output
+
+    def write(self, tags: dict, columns: list, rows: list):
+        for row in rows:
+            record = dict(tags)
+            record.update(zip(columns, row))
+            self.stream.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def close(self):
+        if self.output:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class CsvWriter:
+    """
+    Запись строк результата в CSV. Заголовок формируется по столбцам первого полученного результата
+    """
+    def __init__(self, output: str = None):
+        self.stream = open(output, 'w', encoding='utf-8', newline='') if output else sys.stdout
+        self.output = output
+        self.writer = csv.writer(self.stream)
+        self.columns = None
+
+    def write(self, tags: dict, columns: list, rows: list):
+        if self.columns is None:
+            self.columns = list(columns)
+            self.writer.writerow(list(TAG_COLUMNS) + self.columns)
+        tag_values = [tags[name] for name in TAG_COLUMNS]
+        self.writer.writerows(tag_values + list(row) for row in rows)
+
+    def close(self):
+        if self.output:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class ParquetWriter:
+    """
+    Запись строк результата в колоночный файл Parquet, каждая пачка строк - группа строк файла.
+    Схема определяется по первому полученному результату. Требуется модуль pyarrow
+    """
+    def __init__(self, output: str = None):
+        if not output:
+            raise ValueError("Для формата parquet требуется указать файл")
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("Для формата parquet требуется модуль pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.output = output
+        self.writer = None
+
+    def write(self, tags: dict, columns: list, rows: list):
+        data = {name: [tags[name]] * len(rows) for name in TAG_COLUMNS}
+        data.update({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+        if self.writer is None:
+            table = self.pa.Table.from_pydict(data)
+            self.writer = self.pq.ParquetWriter(self.output, table.schema)
+        else:
+            table = self.pa.Table.from_pydict(data, schema=self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {'jsonl': JsonlWriter, 'csv': CsvWriter, 'parquet': ParquetWriter}
+
+
+def open_writer(fmt: str, output: str = None):
+    """
+    Создание объекта записи результата
+    :param fmt: формат: jsonl, csv или parquet
+    :param output: путь к файлу, если не указан - вывод в stdout (кроме parquet)
+    :return: объект с методами write(tags, columns, rows) и close()
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    return WRITERS[fmt](output)
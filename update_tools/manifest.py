@@ -0,0 +1,182 @@
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+
+CACHE_DIR = Path.home() / '.cache' / 'mis_support'
+READ_BUFFER = 1024 * 1024
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Алгоритмы подсчёта сумм и соответствующие им команды на удалённом хосте
+HASH_ALGORITHMS = {
+    'md5': 'md5sum -b',
+    'sha1': 'sha1sum -b',
+    'sha256': 'sha256sum -b',
+    'blake2b': 'b2sum -b',
+    'xxh64': 'xxh64sum',
+}
+
+
+def new_hash(algorithm: str = 'md5'):
+    """
+    Создание объекта подсчёта суммы. xxh64 доступен при установленном модуле xxhash
+    :param algorithm: имя алгоритма из HASH_ALGORITHMS
+    :return: объект с методами update и hexdigest
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Неизвестный алгоритм подсчёта сумм: {algorithm}")
+    if algorithm == 'xxh64':
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError("Для алгоритма xxh64 требуется модуль xxhash")
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+def file_digest(filename, algorithm: str = 'md5') -> str:
+    """
+    Подсчёт суммы файла. Большие файлы читаются через mmap, остальные - блоками по READ_BUFFER
+    :param filename: путь к файлу
+    :param algorithm: имя алгоритма из HASH_ALGORITHMS
+    :return: сумма файла
+    """
+    result = new_hash(algorithm)
+    with open(filename, 'rb') as fn:
+        if os.fstat(fn.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(fn.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                result.update(data)
+        else:
+            while d := fn.read(READ_BUFFER):
+                result.update(d)
+    return result.hexdigest()
+
+
+def remote_hash_command(algorithm: str = 'md5') -> str:
+    """
+    Команда подсчёта сумм на удалённом хосте, соответствующая алгоритму локального подсчёта
+    :param algorithm: имя алгоритма из HASH_ALGORITHMS
+    :return: команда, принимающая пути к файлам аргументами
+    """
+    new_hash(algorithm)
+    return HASH_ALGORITHMS[algorithm]
+
+
+def parse_hash_line(line: str) -> tuple:
+    """
+    Разбор строки вывода md5sum и аналогичных команд: "сумма *файл" или "сумма  файл"
+    :param line: строка вывода
+    :return: (сумма, путь к файлу)
+    """
+    line = line.rstrip('\r\n')
+    file_hash = line.split(' ', 1)[0]
+    return file_hash, line[len(file_hash) + 2:]
+
+
+class LocalManifestCache:
+    """
+    Кэш сумм файлов локального каталога, сохраняемый на диск между запусками.
+    Ключ - путь к файлу внутри каталога, значение - размер, время изменения и сумма файла.
+    Вместе с суммами хранится алгоритм их подсчёта.
+    """
+    def __init__(self, path: Path, algorithm: str = 'md5'):
+        self.path = Path(path)
+        self.algorithm = algorithm
+        self.entries = {}
+
+    def load(self):
+        """
+        Загрузка кэша с диска. Повреждённый или отсутствующий файл кэша, как и кэш, подсчитанный другим
+        алгоритмом, означает пустой кэш
+        """
+        try:
+            with open(self.path, encoding='utf-8') as fn:
+                data = json.load(fn)
+        except (OSError, ValueError):
+            data = {}
+        if isinstance(data, dict) and data.get('algorithm') == self.algorithm:
+            self.entries = data.get('files', {})
+        else:
+            self.entries = {}
+
+    def save(self, entries: dict):
+        """
+        Запись кэша на диск. Файл заменяется атомарно, чтобы прерванный запуск не оставил повреждённый кэш
+        :param entries: словарь {путь: [размер, время изменения, сумма]}
+        """
+        self.entries = entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fn:
+            json.dump({'algorithm': self.algorithm, 'files': entries}, fn)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, file: str, stat: os.stat_result):
+        """
+        Возвращает сумму файла из кэша, если размер и время изменения файла не изменились
+        :param file: путь к файлу внутри каталога
+        :param stat: результат os.stat для файла
+        :return: сумма файла или None
+        """
+        entry = self.entries.get(file)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+
+REMOTE_MANIFEST_DIR = '/var/lib/mis_support/'
+
+
+def remote_manifest_path(soft: str, remote_path: str) -> str:
+    """
+    Путь к сохранённому манифесту файлов на удалённом хосте
+    :param soft: имя сервиса
+    :param remote_path: каталог клиента на удалённом хосте
+    :return: путь к файлу манифеста
+    """
+    name = hashlib.md5(str(remote_path).encode()).hexdigest()[:8]
+    return f"{REMOTE_MANIFEST_DIR}{soft}_{name}.json"
+
+
+def parse_find_listing(lines) -> dict:
+    """
+    Разбор вывода find -printf '%s %T@ %P\\n'
+    :param lines: итератор строк
+    :return: словарь {путь: (размер, время изменения)}
+    """
+    listing = {}
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        size, mtime, file = line.split(' ', 2)
+        listing[file] = (int(size), mtime)
+    return listing
+
+
+def load_remote_manifest(data, algorithm: str = 'md5') -> dict:
+    """
+    Разбор сохранённого на удалённом хосте манифеста
+    :param data: содержимое файла манифеста
+    :param algorithm: алгоритм подсчёта сумм текущего запуска
+    :return: словарь {путь: [размер, время изменения, сумма]}, пустой словарь если манифест некорректен
+    или подсчитан другим алгоритмом
+    """
+    try:
+        manifest = json.loads(data)
+    except ValueError:
+        return {}
+    if not isinstance(manifest, dict) or manifest.get('algorithm') != algorithm:
+        return {}
+    return manifest.get('files', {})
+
+
+def dump_remote_manifest(files: dict, algorithm: str = 'md5') -> str:
+    """
+    Формирование содержимого манифеста для сохранения на удалённом хосте
+    :param files: словарь {путь: [размер, время изменения, сумма]}
+    :param algorithm: алгоритм подсчёта сумм
+    :return: строка JSON
+    """
+    return json.dumps({'algorithm': algorithm, 'files': files})
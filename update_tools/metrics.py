@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+
+class HostMetrics:
+    """
+    Метрики обновления одного хоста: длительность этапов, количество файлов, переданные байты, ошибки по классам
+    """
+    def __init__(self, host: str, state: str = None, mo: str = None):
+        self.host = host
+        self.state = state
+        self.mo = mo
+        self.status = None
+        self.phases = {}
+        self.files = 0
+        self.deleted = 0
+        self.bytes = 0
+        self.errors = Counter()
+
+    @property
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+    def add_error(self, err):
+        """
+        Учёт ошибки
+        :param err: исключение или имя класса ошибки
+        """
+        self.errors[err if isinstance(err, str) else type(err).__name__] += 1
+
+    def as_dict(self) -> dict:
+        return {'host': self.host, 'state': self.state, 'mo': self.mo, 'status': self.status,
+                'total': round(self.total, 3), 'phases': {name: round(value, 3) for name, value in self.phases.items()},
+                'files': self.files, 'deleted': self.deleted, 'bytes': self.bytes, 'errors': dict(self.errors)}
+
+
+class RolloutMetrics:
+    """
+    Метрики запуска обновления клиента. Выгружаются в JSON lines (строка на хост) и в текстовый формат Prometheus
+    для textfile collector node exporter
+    """
+    def __init__(self, soft: str):
+        self.soft = soft
+        self.run_id = uuid.uuid4().hex
+        self.started = time.time()
+        self.phases = {}
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, host: str, state: str = None, mo: str = None) -> HostMetrics:
+        """
+        Создание метрик хоста
+        """
+        metrics = HostMetrics(host, state, mo)
+        with self._lock:
+            self.hosts[host] = metrics
+        return metrics
+
+    @contextmanager
+    def phase(self, name: str, host_metrics: HostMetrics = None):
+        """
+        Замер длительности этапа хоста или, если хост не указан, этапа запуска. Исключение учитывается
+        в ошибках хоста и передаётся дальше
+        :param name: имя этапа
+        :param host_metrics: метрики хоста
+        """
+        phases = host_metrics.phases if host_metrics else self.phases
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as err:
+            if host_metrics:
+                host_metrics.add_error(err)
+            raise
+        finally:
+            phases[name] = phases.get(name, 0.0) + time.monotonic() - start
+
+    def slowest(self, limit: int = 10) -> list:
+        """
+        Хосты, отсортированные по убыванию общей длительности обновления
+        """
+        return sorted(self.hosts.values(), key=lambda metrics: metrics.total, reverse=True)[:limit]
+
+    def summary(self, limit: int = 10) -> str:
+        """
+        Текстовая сводка по самым медленным хостам
+        """
+        lines = [f"Самые медленные хосты (всего {len(self.hosts)}):"]
+        for metrics in self.slowest(limit):
+            phases = ', '.join(f"{name} {value:.1f} с" for name, value in
+                               sorted(metrics.phases.items(), key=lambda item: item[1], reverse=True))
+            lines.append(f"{metrics.host} {metrics.state or ''} {metrics.mo or ''}: {metrics.total:.1f} с "
+                         f"({phases}), файлов {metrics.files}, байт {metrics.bytes}, статус {metrics.status}")
+        return '\n'.join(lines)
+
+    def write_jsonl(self, path: str):
+        """
+        Дозапись метрик хостов в файл JSON lines, строка на хост
+        """
+        with open(path, 'a', encoding='utf-8') as fn:
+            for metrics in self.hosts.values():
+                record = {'run_id': self.run_id, 'timestamp': self.started, 'soft': self.soft,
+                          'run_phases': {name: round(value, 3) for name, value in self.phases.items()}}
+                record.update(metrics.as_dict())
+                fn.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+    def prometheus(self) -> str:
+        """
+        Метрики запуска в текстовом формате Prometheus
+        """
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{self._labels(**labels)} {value}" for labels, value in samples)
+
+        hosts = list(self.hosts.values())
+        metric('mis_rollout_last_run_timestamp_seconds', 'Start time of the last rollout run',
+               [({'soft': self.soft}, self.started)])
+        metric('mis_rollout_run_phase_seconds', 'Duration of run-level rollout phases',
+               [({'soft': self.soft, 'phase': name}, round(value, 3)) for name, value in self.phases.items()])
+        metric('mis_rollout_phase_seconds', 'Duration of rollout phases per host',
+               [({'soft': self.soft, 'host': m.host, 'state': m.state or '', 'phase': name}, round(value, 3))
+                for m in hosts for name, value in m.phases.items()])
+        metric('mis_rollout_files', 'Files copied per host',
+               [({'soft': self.soft, 'host': m.host}, m.files) for m in hosts])
+        metric('mis_rollout_bytes_sent', 'Bytes sent per host',
+               [({'soft': self.soft, 'host': m.host}, m.bytes) for m in hosts])
+        metric('mis_rollout_errors', 'Errors per host and error class',
+               [({'soft': self.soft, 'host': m.host, 'error_class': error}, count)
+                for m in hosts for error, count in m.errors.items()])
+        metric('mis_rollout_host_status', 'Result of the rollout per host',
+               [({'soft': self.soft, 'host': m.host, 'status': m.status or 'unknown'}, 1) for m in hosts])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """
+        Запись метрик в файл для textfile collector. Файл заменяется атомарно
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as fn:
+            fn.write(self.prometheus())
+        os.replace(tmp_path, path)
@@ -1,6 +1,9 @@
-from sqlalchemy import Column, Integer, String, create_engine, Boolean, ForeignKey, Date, Text, DateTime
+import threading
+import time
+from sqlalchemy import Column, Integer, String, create_engine, Boolean, ForeignKey, Date, Text, DateTime, Float, UniqueConstraint, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import QueuePool
 from config import settings
 
 Base = declarative_base()
@@ -70,6 +73,44 @@ class Logupdatedbmis(Base):
     release_id = Column(Integer, ForeignKey('misupdate_updatequeries.id'))
 
 
+class Logstatementdbmis(Base):
+
+    __tablename__ = 'misupdate_logstatementdbmis'
+
+    id = Column(Integer, primary_key=True)
+    updateDate = Column(DateTime)
+    host_id = Column(Integer, ForeignKey('misinfo_servers.id'))
+    release_id = Column(Integer, ForeignKey('misupdate_updatequeries.id'))
+    statementIndex = Column(Integer)
+    statement = Column(String(500))
+    duration = Column(Float)
+    rowsAffected = Column(Integer)
+    result = Column(Boolean)
+    comment = Column(String(500))
+
+
+class Checkpointdbmis(Base):
+
+    __tablename__ = 'misupdate_checkpointdbmis'
+    __table_args__ = (UniqueConstraint('host_id', 'release_id'),)
+
+    id = Column(Integer, primary_key=True)
+    updateDate = Column(DateTime)
+    host_id = Column(Integer, ForeignKey('misinfo_servers.id'))
+    release_id = Column(Integer, ForeignKey('misupdate_updatequeries.id'))
+    statementIndex = Column(Integer)
+    releaseHash = Column(String(64))
+
+
+def create_tables(session, tables: list):
+    """
+    Создание отсутствующих в БД таблиц моделей, существующие таблицы не изменяются
+    :param session: сессия БД
+    :param tables: классы моделей
+    """
+    Base.metadata.create_all(bind=session.get_bind(), tables=[table.__table__ for table in tables], checkfirst=True)
+
+
 class Authdata(Base):
     __tablename__ = 'misinfo_authdata'
 
@@ -82,22 +123,144 @@ class Authdata(Base):
         return f"<misinfo_authdata({self.user =}, {self.password =})>"
 
 
+class _TimedQueuePool(QueuePool):
+    """
+    Пул соединений, сообщающий реестру время ожидания соединения
+    """
+    registry = None
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            self.registry.record_checkout_wait(time.monotonic() - start)
+
+
+class EngineRegistry:
+    """
+    Реестр движков SQLAlchemy процесса. Для каждой строки подключения создаётся один движок с пулом соединений,
+    который переиспользуется всеми подключениями к этой БД
+    """
+    def __init__(self, pool_size: int = 5, max_overflow: int = 10, pool_pre_ping: bool = True,
+                 pool_recycle: int = 3600, pool_timeout: int = 30):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_pre_ping = pool_pre_ping
+        self.pool_recycle = pool_recycle
+        self.pool_timeout = pool_timeout
+        self._engines = {}
+        self._sessionmakers = {}
+        self._lock = threading.Lock()
+        self._poolclass = type('TimedQueuePool', (_TimedQueuePool,), {'registry': self})
+        self.stats = {'engine_hits': 0, 'engine_misses': 0, 'pool_hits': 0, 'pool_misses': 0,
+                      'checkouts': 0, 'checkout_wait': 0.0, 'checkout_wait_max': 0.0}
+
+    def configure(self, **kwargs):
+        """
+        Изменение параметров пула для создаваемых движков: pool_size, max_overflow, pool_pre_ping,
+        pool_recycle, pool_timeout. Уже созданные движки закрываются
+        """
+        for key, value in kwargs.items():
+            if key not in ('pool_size', 'max_overflow', 'pool_pre_ping', 'pool_recycle', 'pool_timeout'):
+                raise ValueError(f"Неизвестный параметр пула: {key}")
+            setattr(self, key, value)
+        self.dispose_all()
+
+    def _count(self, key: str, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def record_checkout_wait(self, seconds: float):
+        """
+        Учёт времени ожидания соединения из пула
+        :param seconds: время ожидания
+        """
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['checkout_wait'] += seconds
+            self.stats['checkout_wait_max'] = max(self.stats['checkout_wait_max'], seconds)
+
+    def get(self, dsn: str):
+        """
+        Возвращает движок для строки подключения, создавая его при первом обращении
+        :param dsn: строка подключения
+        :return: Engine
+        """
+        with self._lock:
+            engine = self._engines.get(dsn)
+            if engine is not None:
+                self.stats['engine_hits'] += 1
+                return engine
+            self.stats['engine_misses'] += 1
+            engine = create_engine(dsn, poolclass=self._poolclass, pool_size=self.pool_size,
+                                   max_overflow=self.max_overflow, pool_pre_ping=self.pool_pre_ping,
+                                   pool_recycle=self.pool_recycle, pool_timeout=self.pool_timeout)
+            event.listen(engine, 'connect', lambda *args: self._count('pool_misses'))
+            event.listen(engine, 'checkout', lambda *args: self._count('pool_hits'))
+            self._engines[dsn] = engine
+            self._sessionmakers[dsn] = sessionmaker(bind=engine)
+            return engine
+
+    def session(self, dsn: str):
+        """
+        Создание сессии с движком из реестра
+        :param dsn: строка подключения
+        :return: Session
+        """
+        self.get(dsn)
+        return self._sessionmakers[dsn]()
+
+    def get_stats(self) -> dict:
+        """
+        Статистика реестра: попадания и промахи по движкам и соединениям пула, время ожидания соединений
+        :return: словарь со статистикой
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        # событие checkout срабатывает и для новых соединений, попадание - выдача уже открытого соединения
+        stats['pool_hits'] -= stats['pool_misses']
+        return stats
+
+    def dispose_all(self):
+        """
+        Закрытие всех движков и их пулов соединений
+        """
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+            self._sessionmakers.clear()
+        for engine in engines:
+            engine.dispose()
+
+
+engines = EngineRegistry()
+
+
+# pymysql.constants.CLIENT.MULTI_STATEMENTS: выполнение нескольких запросов одним обращением к серверу
+CLIENT_MULTI_STATEMENTS = 1 << 16
+
+
 class DatabaseConnection:
-    def __init__(self, host=settings.DB_HOST, port=settings.DB_PORT, user=settings.DB_USER, password=settings.DB_PASSWORD, db_name=settings.DB_NAME):
+    def __init__(self, host=settings.DB_HOST, port=settings.DB_PORT, user=settings.DB_USER, password=settings.DB_PASSWORD, db_name=settings.DB_NAME,
+                 multi_statements=False):
         self.host = host
         self.user = user
         self.password = password
         self.db_name = db_name
         self.port = port
+        self.multi_statements = multi_statements
 
     def __enter__(self):
         """
-        Создаём подключение к БД
+        Создаём подключение к БД. Движок и пул соединений берутся из реестра engines.
+        При multi_statements подключения разрешают несколько запросов в одном обращении (отдельный пул)
         :return:
         """
-        engine = create_engine(f'mysql+pymysql://{self.user}:{self.password}@{self.host}:{self.port}/{self.db_name}')
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+        dsn = f'mysql+pymysql://{self.user}:{self.password}@{self.host}:{self.port}/{self.db_name}'
+        if self.multi_statements:
+            dsn += f'?client_flag={CLIENT_MULTI_STATEMENTS}'
+        self.session = engines.session(dsn)
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -0,0 +1,63 @@
+import shlex
+from pathlib import PurePosixPath
+
+
+class PermissionPolicy:
+    """
+    Права на файлы клиента: владелец, права каталогов и файлов, исполняемые файлы.
+    Применяется ко всему каталогу (full_command) или только к созданным и изменённым файлам и их каталогам
+    """
+    def __init__(self, owner: str = None, dir_mode: str = '775', file_mode: str = '664', executables: tuple = ()):
+        self.owner = owner
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        self.executables = executables
+
+    def full_command(self, path: str) -> str:
+        """
+        Команда установки прав на весь каталог
+        :param path: каталог клиента на удалённом хосте
+        :return: команда
+        """
+        commands = [f'chown {self.owner} -R {path}'] if self.owner else []
+        commands += [f'chmod {self.dir_mode} -R {path}',
+                     f'find {path} -type f | xargs -d "\\n" chmod {self.file_mode}']
+        commands += [f'chmod +x {path}{file}' for file in self.executables]
+        return ' && '.join(commands)
+
+    def paths_command(self, path: str, mode: str) -> str:
+        """
+        Команда установки владельца и прав на пути, переданные в stdin через \\0
+        :param path: каталог клиента на удалённом хосте
+        :param mode: права
+        :return: команда
+        """
+        script = f'chown {self.owner} -- "$@" && chmod {mode} -- "$@"' if self.owner else f'chmod {mode} -- "$@"'
+        return f"cd {path} && xargs -0 -r sh -c {shlex.quote(script)} sh"
+
+    def incremental(self, path: str, files) -> list:
+        """
+        Команды установки прав на изменённые файлы и их каталоги
+        :param path: каталог клиента на удалённом хосте
+        :param files: пути к изменённым файлам внутри каталога
+        :return: список (команда, пути для передачи в stdin)
+        """
+        dirs = set()
+        for file in files:
+            dirs.update(str(parent) for parent in PurePosixPath(file).parents)
+        commands = [(self.paths_command(path, self.dir_mode), sorted(dirs)),
+                    (self.paths_command(path, self.file_mode), sorted(files))]
+        executables = [file for file in self.executables if file in files]
+        if executables:
+            commands.append((f"cd {path} && chmod +x -- {' '.join(shlex.quote(file) for file in executables)}", []))
+        return commands
+
+
+PERMISSION_POLICIES = {
+    'mis': PermissionPolicy('tsadmin:samsonuser', executables=(
+        's11main.py', 'appendix/regional/r23/importReestr/importReestr.py')),
+    'iemk': PermissionPolicy('root:root', executables=(
+        'run_iemk.sh', 'run_putev.sh', 'IEMK/IEMKrequest.php', 'putevFactExecs.py', 'run_smphosp.sh')),
+    # для soap права не меняются, после обновления перезапускается веб-сервер
+    'soap': None,
+}
@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TokenBucket:
+    """
+    Ограничение скорости передачи данных: байты списываются из корзины, пополняемой со скоростью rate в секунду.
+    Одна корзина используется всеми хостами группы. Списанные байты списываются и из корзины parent
+    (общее ограничение скорости для всех групп)
+    """
+    def __init__(self, rate: float, burst: float = None, parent: 'TokenBucket' = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.parent = parent
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """
+        Списание байтов, при нехватке ожидание пополнения корзины
+        :param amount: количество байтов
+        """
+        while amount > 0:
+            chunk = min(amount, self.capacity)
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= chunk:
+                    self.tokens -= chunk
+                    delay = 0
+                else:
+                    delay = (chunk - self.tokens) / self.rate
+            if delay:
+                time.sleep(delay)
+                continue
+            amount -= chunk
+            if self.parent:
+                self.parent.consume(chunk)
+
+
+class ThrottledWriter:
+    """
+    Обёртка потока записи, ограничивающая скорость записи корзиной TokenBucket
+    """
+    def __init__(self, stream, bucket: TokenBucket):
+        self.stream = stream
+        self.bucket = bucket
+
+    def write(self, data):
+        self.bucket.consume(len(data))
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class RolloutScheduler:
+    """
+    Планировщик обновления хостов по группам (районам Mo.state). Хосты разных групп чередуются,
+    количество одновременно обновляемых хостов ограничено общим лимитом workers и лимитом группы group_workers,
+    скорость передачи данных группы - group_rate байт/с (для отдельных групп - group_rates),
+    общая скорость передачи данных всех групп - total_rate байт/с.
+    Первыми обновляются canary хостов из разных групп, остальные хосты обновляются только если
+    все они обновлены успешно
+    """
+    def __init__(self, workers: int = 1, group_workers: int = None, group_rate: int = None, canary: int = 0,
+                 group_rates: dict = None, total_rate: int = None):
+        self.workers = max(1, workers)
+        self.group_workers = group_workers
+        self.group_rate = group_rate
+        self.group_rates = group_rates or {}
+        self.canary = canary
+        self.aborted = []
+        self._total = TokenBucket(total_rate) if total_rate else None
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def throttle(self, group):
+        """
+        Возвращает корзину ограничения скорости группы, байты которой списываются и из общей корзины
+        :param group: группа
+        :return: TokenBucket или None, если скорость не ограничена
+        """
+        rate = self.group_rates.get(group, self.group_rate)
+        if not rate:
+            return self._total
+        with self._lock:
+            if group not in self._buckets:
+                self._buckets[group] = TokenBucket(rate, parent=self._total)
+            return self._buckets[group]
+
+    @staticmethod
+    def _groups(items: list, indexes, group) -> OrderedDict:
+        queues = OrderedDict()
+        for index in indexes:
+            queues.setdefault(group(items[index]), deque()).append(index)
+        return queues
+
+    def canary_wave(self, items: list, group) -> list:
+        """
+        Выбор хостов пробной волны: по одному хосту из групп по очереди
+        :param items: хосты
+        :param group: функция, возвращающая группу хоста
+        :return: номера хостов пробной волны в items
+        """
+        queues = self._groups(items, range(len(items)), group)
+        wave = []
+        while queues and len(wave) < self.canary:
+            for key in list(queues):
+                if len(wave) >= self.canary:
+                    break
+                wave.append(queues[key].popleft())
+                if not queues[key]:
+                    del queues[key]
+        return wave
+
+    def _run_wave(self, items: list, indexes, group, func, done) -> list:
+        queues = self._groups(items, indexes, group)
+        running = Counter()
+        pending = {}
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while queues or pending:
+                # группы обходятся по кругу, пока не занято workers потоков или все группы с хостами
+                # не достигли лимита group_workers; по одному хосту из группы за проход
+                submitted = True
+                while submitted and len(pending) < self.workers:
+                    submitted = False
+                    for key in list(queues):
+                        if len(pending) >= self.workers:
+                            break
+                        if self.group_workers and running[key] >= self.group_workers:
+                            continue
+                        item = items[queues[key].popleft()]
+                        if queues[key]:
+                            queues.move_to_end(key)
+                        else:
+                            del queues[key]
+                        running[key] += 1
+                        pending[executor.submit(func, item, self.throttle(key))] = (key, item)
+                        submitted = True
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, item = pending.pop(future)
+                    running[key] -= 1
+                    result = future.result()
+                    results.append((item, result))
+                    if done:
+                        done(item, result)
+        return results
+
+    def run(self, items, group, func, succeeded, done=None) -> list:
+        """
+        Обновление хостов: пробная волна, затем остальные хосты
+        :param items: хосты
+        :param group: функция, возвращающая группу хоста
+        :param func: функция обновления хоста func(хост, TokenBucket или None) -> результат
+        :param succeeded: функция, проверяющая успешность обновления по результату
+        :param done: функция, вызываемая в основном потоке по завершении обновления хоста: done(хост, результат)
+        :return: список (хост, результат); хосты, не обновлявшиеся из-за ошибок пробной волны, - в aborted
+        """
+        items = list(items)
+        self.aborted = []
+        wave = self.canary_wave(items, group) if self.canary else []
+        rest = sorted(set(range(len(items))) - set(wave))
+        results = []
+        if wave:
+            print(f"Пробная волна: {len(wave)} хостов")
+            results = self._run_wave(items, wave, group, func, done)
+            if not all(succeeded(result) for _, result in results):
+                self.aborted = [items[index] for index in rest]
+                print(f"Пробная волна завершилась с ошибками, обновление остальных {len(rest)} хостов отменено")
+                return results
+        return results + self._run_wave(items, rest, group, func, done)
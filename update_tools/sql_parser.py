@@ -0,0 +1,165 @@
+import hashlib
+import re
+import threading
+
+DELIMITER_RE = re.compile(r'[ \t]*DELIMITER[ \t]+(\S+)[^\n]*(?:\n|$)', re.I)
+KEYWORD_RE = re.compile(r'\w+')
+QUOTES = '\'"`'
+
+
+def _plain_re(delimiter: str):
+    """
+    Регулярное выражение для участка текста без кавычек, комментариев, переводов строк и разделителя
+    """
+    specials = set(QUOTES + '-#/\n' + delimiter[0])
+    return re.compile('[^' + ''.join(re.escape(c) for c in specials) + ']+')
+
+
+def _skip_quoted(script: str, pos: int) -> int:
+    """
+    Возвращает позицию после закрывающей кавычки строки или идентификатора, начинающегося в pos.
+    Учитываются экранирование обратной косой чертой (кроме `) и удвоенные кавычки
+    """
+    quote = script[pos]
+    pos += 1
+    while pos < len(script):
+        char = script[pos]
+        if char == '\\' and quote != '`':
+            pos += 2
+            continue
+        if char == quote:
+            if script.startswith(quote, pos + 1):
+                pos += 2
+                continue
+            return pos + 1
+        pos += 1
+    return pos
+
+
+def _is_line_comment(script: str, pos: int) -> bool:
+    """
+    Начинается ли в pos однострочный комментарий: # или -- с последующим пробельным символом
+    """
+    return script[pos] == '#' or (script.startswith('--', pos) and script[pos + 2:pos + 3] in ('', ' ', '\t', '\r', '\n'))
+
+
+def first_keyword(statement: str) -> str:
+    """
+    Первое ключевое слово запроса. Комментарии и пробельные символы в начале запроса пропускаются,
+    исполняемый комментарий /*! ... */ считается кодом
+    :param statement: текст запроса
+    :return: ключевое слово в верхнем регистре или пустая строка, если запрос начинается не со слова
+    """
+    pos = 0
+    length = len(statement)
+    while pos < length:
+        if statement[pos].isspace():
+            pos += 1
+        elif _is_line_comment(statement, pos):
+            end = statement.find('\n', pos)
+            pos = length if end == -1 else end
+        elif statement.startswith('/*', pos) and not statement.startswith('/*!', pos):
+            end = statement.find('*/', pos + 2)
+            pos = length if end == -1 else end + 2
+        else:
+            match = KEYWORD_RE.match(statement, pos)
+            return match.group().upper() if match else ''
+    return ''
+
+
+def iter_statements(script: str, delimiter: str = ';'):
+    """
+    Разбор SQL скрипта на запросы за один проход. Разделитель внутри строк, идентификаторов и комментариев
+    не учитывается, команда DELIMITER в начале строки меняет разделитель. Запросы без кода (пустые или
+    состоящие только из комментариев) пропускаются
+    :param script: текст скрипта
+    :param delimiter: разделитель запросов
+    :return: генератор запросов
+    """
+    plain = _plain_re(delimiter)
+    start = pos = 0
+    has_code = False
+    length = len(script)
+    while pos < length:
+        if pos == 0 or script[pos - 1] == '\n':
+            match = DELIMITER_RE.match(script, pos)
+            if match:
+                if has_code:
+                    yield script[start:pos].strip()
+                delimiter = match.group(1)
+                plain = _plain_re(delimiter)
+                start = pos = match.end()
+                has_code = False
+                continue
+        match = plain.match(script, pos)
+        if match:
+            has_code = has_code or not match.group().isspace()
+            pos = match.end()
+            continue
+        char = script[pos]
+        if script.startswith(delimiter, pos):
+            if has_code:
+                yield script[start:pos].strip()
+            pos += len(delimiter)
+            start = pos
+            has_code = False
+        elif char in QUOTES:
+            pos = _skip_quoted(script, pos)
+            has_code = True
+        elif _is_line_comment(script, pos):
+            end = script.find('\n', pos)
+            pos = length if end == -1 else end
+        elif script.startswith('/*', pos):
+            end = script.find('*/', pos + 2)
+            # исполняемый комментарий /*! ... */ выполняется сервером
+            has_code = has_code or script.startswith('/*!', pos)
+            pos = length if end == -1 else end + 2
+        else:
+            has_code = has_code or not char.isspace()
+            pos += 1
+    if has_code:
+        yield script[start:].strip()
+
+
+class ReleaseCache:
+    """
+    Кэш разобранных запросов релизов на время запуска, общий для всех серверов.
+    Разобранные запросы хранятся по хэшу текста скрипта, поэтому одинаковые скрипты разбираются один раз.
+    """
+    def __init__(self):
+        self._statements = {}
+        self._releases = {}
+        self._lock = threading.Lock()
+
+    def get(self, release: str):
+        """
+        Возвращает разобранные запросы релиза
+        :param release: версия релиза
+        :return: кортеж запросов или None, если релиз ещё не разобран
+        """
+        with self._lock:
+            digest = self._releases.get(release)
+            return self._statements.get(digest) if digest else None
+
+    def digest(self, release: str):
+        """
+        Возвращает хэш скрипта релиза
+        :param release: версия релиза
+        :return: sha256 текста скрипта или None, если релиз ещё не разобран
+        """
+        with self._lock:
+            return self._releases.get(release)
+
+    def put(self, release: str, script: str) -> tuple:
+        """
+        Разбор скрипта релиза и сохранение результата в кэше
+        :param release: версия релиза
+        :param script: текст скрипта
+        :return: кортеж запросов
+        """
+        digest = hashlib.sha256(script.encode()).hexdigest()
+        with self._lock:
+            if digest not in self._statements:
+                self._statements[digest] = tuple(iter_statements(script))
+            self._releases[release] = digest
+            return self._statements[digest]
@@ -0,0 +1,118 @@
+import socket
+import threading
+from functools import lru_cache
+from paramiko import RSAKey, SSHClient, AutoAddPolicy, SSHException
+from config import settings
+
+
+@lru_cache(maxsize=None)
+def get_ssh_key() -> RSAKey:
+    """
+    Загрузка ключа для авторизации на хостах. Ключ читается при первом обращении
+    :return: ключ RSA
+    """
+    return RSAKey.from_private_key_file(settings.SSH_AUTH_KEY)
+
+
+class SSHSessionPool:
+    """
+    Пул SSH подключений. Для каждого хоста хранится одно авторизованное подключение и одна сессия SFTP,
+    все этапы обновления открывают свои каналы поверх него. Подключения проверяются перед выдачей и
+    переиспользуются между последовательными запусками обновления в одном процессе.
+    """
+    def __init__(self, username: str = 'root', port: int = 22, keepalive: int = 30):
+        self.username = username
+        self.port = port
+        self.keepalive = keepalive
+        self._clients = {}
+        self._sftp = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _host_lock(self, host: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(host, threading.Lock())
+
+    @staticmethod
+    def is_alive(client: SSHClient) -> bool:
+        """
+        Проверка подключения: транспорт активен и отвечает на служебное сообщение
+        :param client: подключение
+        :return: True - подключение можно использовать
+        """
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (SSHException, EOFError, socket.error):
+            return False
+        return True
+
+    def connect(self, host: str) -> SSHClient:
+        """
+        Создание нового подключения к хосту
+        :param host: IP адрес хоста
+        :return: подключение
+        """
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(hostname=host, port=self.port, username=self.username, pkey=get_ssh_key())
+        client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def get(self, host: str) -> SSHClient:
+        """
+        Возвращает рабочее подключение к хосту из пула, при необходимости подключается заново.
+        Ошибки подключения передаются вызывающему коду
+        :param host: IP адрес хоста
+        :return: подключение
+        """
+        with self._host_lock(host):
+            client = self._clients.get(host)
+            if client is not None and self.is_alive(client):
+                return client
+            self._close(host)
+            client = self.connect(host)
+            self._clients[host] = client
+            return client
+
+    def sftp(self, host: str):
+        """
+        Возвращает сессию SFTP поверх подключения к хосту из пула
+        :param host: IP адрес хоста
+        :return: SFTPClient
+        """
+        client = self.get(host)
+        with self._host_lock(host):
+            sftp = self._sftp.get(host)
+            if sftp is None or sftp.get_channel().closed:
+                sftp = client.open_sftp()
+                self._sftp[host] = sftp
+            return sftp
+
+    def _close(self, host: str):
+        sftp = self._sftp.pop(host, None)
+        if sftp is not None:
+            sftp.close()
+        client = self._clients.pop(host, None)
+        if client is not None:
+            client.close()
+
+    def release(self, host: str):
+        """
+        Закрытие подключения к хосту
+        :param host: IP адрес хоста
+        """
+        with self._host_lock(host):
+            self._close(host)
+
+    def close_all(self):
+        """
+        Закрытие всех подключений пула
+        """
+        for host in list(self._clients):
+            self.release(host)
+
+
+SSH_POOL = SSHSessionPool()